@@ -0,0 +1,114 @@
+import argparse
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+
+import numpy as np
+from PIL import Image
+
+import make_video_pdf_engine as engine
+
+
+def make_test_pages(count, width=engine.VIDEO_WIDTH, height=1527):
+    """
+    Makes synthetic page images at the size a portrait page is rendered at on the canvas.
+    """
+    rng = np.random.default_rng(0)
+    pages = []
+    for _ in range(count):
+        page = np.full((height, width, 3), 255, dtype=np.uint8)
+        # A few dark blocks of "text" and a colored "figure"
+        for top in range(100, height - 200, 60):
+            page[top:top + 20, 80:width - rng.integers(80, 400)] = 30
+        page[height // 2:height // 2 + 300, 200:width - 200] = rng.integers(0, 255, 3, dtype=np.uint8)
+        pages.append(Image.fromarray(page))
+    return pages
+
+
+def legacy_composite(page_image, blur_radius, darken_factor):
+    """
+    The original process_image pipeline: full resolution scale, crop, blur, brightness and overlay.
+    """
+    scaled_image = engine.scale_image(page_image, engine.VIDEO_WIDTH, engine.VIDEO_HEIGHT)
+    cropped_image = engine.crop_image(scaled_image, engine.VIDEO_WIDTH, engine.VIDEO_HEIGHT)
+    processed_image = engine.apply_blur_and_darken(cropped_image, blur_radius, darken_factor)
+    return engine.overlay_images(processed_image, page_image)
+
+
+def engine_composite(page_image, blur_radius, darken_factor, compositor):
+    """
+    The current pipeline: low resolution background and NumPy composite.
+    """
+    background = engine.make_background(page_image, blur_radius, darken_factor)
+    return compositor.composite(page_image, background)
+
+
+def time_per_page(function, pages, *args):
+    start = time.perf_counter()
+    for page in pages:
+        function(page, *args)
+    return (time.perf_counter() - start) / len(pages) * 1000
+
+
+def time_frame_formats(frames, folder):
+    """
+    Times writing each intermediate frame format, reading it back with Pillow and decoding it with ffmpeg.
+    Returns {format: (write ms, read ms, ffmpeg ms or None, bytes)} per frame.
+    """
+    ffmpeg = shutil.which('ffmpeg.exe') or shutil.which('ffmpeg')
+    results = {}
+    for frame_format, ext in engine.FRAME_FORMATS.items():
+        paths = [os.path.join(folder, f'frame{i}{ext}') for i in range(len(frames))]
+
+        start = time.perf_counter()
+        for frame, path in zip(frames, paths):
+            engine.save_frame(frame, path)
+        write = (time.perf_counter() - start) / len(frames) * 1000
+
+        start = time.perf_counter()
+        for path in paths:
+            engine.load_frame(path).load()
+        read = (time.perf_counter() - start) / len(frames) * 1000
+
+        decode = None
+        if ffmpeg:
+            start = time.perf_counter()
+            for path in paths:
+                frame_input = engine.ffmpeg_frame_input(path).replace('-stream_loop -1 ', '').replace('-loop 1 ', '')
+                subprocess.run(f'"{ffmpeg}" -v error {frame_input} -frames:v 1 -f null -', shell=True, check=True)
+            decode = (time.perf_counter() - start) / len(frames) * 1000
+
+        results[frame_format] = (write, read, decode, os.path.getsize(paths[0]))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the per-page composite of the video engine.")
+    parser.add_argument('--pages', type=int, default=20, help="number of synthetic pages")
+    parser.add_argument('--blur', type=int, default=8, help="background blur radius")
+    parser.add_argument('--brightness', type=float, default=0.5, help="background brightness factor")
+    args = parser.parse_args()
+
+    pages = make_test_pages(args.pages)
+    compositor = engine.FrameCompositor()
+
+    legacy = time_per_page(legacy_composite, pages, args.blur, args.brightness)
+    current = time_per_page(engine_composite, pages, args.blur, args.brightness, compositor)
+
+    print(f"composite, legacy:  {legacy:8.1f} ms/page")
+    print(f"composite, current: {current:8.1f} ms/page ({legacy / current:.1f}x)")
+
+    frames = [engine_composite(page, args.blur, args.brightness, compositor) for page in pages]
+    with tempfile.TemporaryDirectory() as folder:
+        results = time_frame_formats(frames, folder)
+
+    print(f"{'frame format':<14}{'write':>10}{'read':>10}{'ffmpeg':>10}{'size':>10}")
+    for frame_format, (write, read, decode, size) in results.items():
+        decode = f"{decode:8.1f}ms" if decode is not None else f"{'n/a':>10}"
+        print(f"{frame_format:<14}{write:8.1f}ms{read:8.1f}ms{decode}{size / 1024 ** 2:8.2f}MB")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,23 +1,24 @@
 import asyncio
 import os
+import shutil
 import subprocess
 import sys
 from contextlib import closing
 
-import boto3
 import edge_tts
 import fitz  # PyMuPDF
 from botocore.exceptions import BotoCoreError, ClientError
 
+from make_video_pdf_engine import AUDIO_CACHE_FOLDER, AUDIO_CACHE_MAX_BYTES, DiskCache, audio_cache_key, \
+    get_polly_client
+
 AUX_FOLDER = './aux_files/'
 VIDEOS_FOLDER = './videos/'
 
-# Create a client using the credentials and region defined in the [adminuser]
-# section of the AWS credentials file (~/.aws/credentials).
-
-
-polly = boto3.client('polly', region_name='eu-west-3', aws_access_key_id='',
-                     aws_secret_access_key='')
+# Region and credentials of the Polly client, made on the first request by get_polly_client
+POLLY_REGION = 'eu-west-3'
+POLLY_ACCESS_KEY = ''
+POLLY_SECRET_ACCESS_KEY = ''
 
 
 def extract_text_and_images(pdf_file):
@@ -160,7 +161,16 @@ def trim_audio(in_audio_path, out_audio_path):
     subprocess.check_output(trim_audio_clip, shell=True)
 
 
-async def make_audio(text: str, audio_name: str, VOICE: str, speed: str) -> None:
+async def make_audio(text: str, audio_name: str, VOICE: str, speed: str, cache: DiskCache = None) -> None:
+    key = None
+    if cache is not None:
+        key = audio_cache_key(text, VOICE, 'edge-tts', None, speed)
+        cached_path = cache.lookup(key, '.mp3')
+        if cached_path:
+            shutil.copyfile(cached_path, audio_name)
+            print('Cached audio: [' + text + ']' + ' - file: ' + audio_name)
+            return
+
     communicate = edge_tts.Communicate(text, VOICE, rate=speed)
     with open(audio_name, "wb") as file:
         async for chunk in communicate.stream():
@@ -168,8 +178,23 @@ async def make_audio(text: str, audio_name: str, VOICE: str, speed: str) -> None
                 file.write(chunk["data"])
     print('New audio: [' + text + ']' + ' - file: ' + audio_name)
 
+    if key:
+        with open(audio_name, "rb") as audio:
+            cache.store(key, '.mp3', lambda file: shutil.copyfileobj(audio, file))
 
-def make_audio_polly(text, filepath):
+
+def make_audio_polly(text, filepath, cache=None):
+    key = None
+    if cache is not None:
+        key = audio_cache_key(text, "Emma", "neural", 'en-GB')
+        cached_path = cache.lookup(key, '.mp3')
+        if cached_path:
+            shutil.copyfile(cached_path, filepath)
+            return
+
+    # The pages are synthesized one after the other, so boto3 may retry on its own
+    polly = get_polly_client(POLLY_REGION, POLLY_ACCESS_KEY, POLLY_SECRET_ACCESS_KEY, max_concurrency=1,
+                             max_attempts=3)
     try:
         # Request speech synthesis
         response = polly.synthesize_speech(Engine="neural", LanguageCode='en-GB', Text=text, OutputFormat="mp3",
@@ -199,6 +224,10 @@ def make_audio_polly(text, filepath):
         print("Could not stream audio")
         sys.exit(-1)
 
+    if key:
+        with open(filepath, "rb") as audio:
+            cache.store(key, '.mp3', lambda file: shutil.copyfileobj(audio, file))
+
 
 def merge_image_audio(image_in, audio_in, video_out, fade_duration):
     audio_in_2 = audio_in + 'hax.mp3'
@@ -329,6 +358,7 @@ def convert_to_mp4(video_in, video_out):
 
 async def make_clips(data, fade_duration, final_video):
     clips_to_merge = []
+    audio_cache = DiskCache(AUDIO_CACHE_FOLDER, AUDIO_CACHE_MAX_BYTES)
     count = 0
     for i in range(len(data)):
         count += 1
@@ -341,8 +371,8 @@ async def make_clips(data, fade_duration, final_video):
         video_out_mp4 = AUX_FOLDER + video_name
 
         process_image(input_image_path, output_image_path)
-        # # # await make_audio(data[i], audio_name, VOICE, speed, PITCH)
-        make_audio_polly(data[i], audio_name)
+        # # # await make_audio(data[i], audio_name, VOICE, speed, audio_cache)
+        make_audio_polly(data[i], audio_name, audio_cache)
         merge_image_audio(output_image_path, audio_name, video_out_mp4, (fade_duration + 0.5))
 
         clips_to_merge.append(video_out_mp4)
@@ -351,6 +381,7 @@ async def make_clips(data, fade_duration, final_video):
     ffmpeg_fade_merge(clips_to_merge, fade_duration, video_merged)
     add_bg_audio_2(video_merged, 'bg_audio.mp3', final_video)
     convert_to_mp4(final_video, final_video + 'sdsds.mp4')
+    print(f"Audio cache: {audio_cache.hits} hits, {audio_cache.misses} misses")
 
 
 def find_pdfs(folder_path):
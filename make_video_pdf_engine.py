@@ -1,43 +1,460 @@
 import argparse
+import asyncio
+import hashlib
+import json
 import os
+import random
+import re
+import shutil
 import subprocess
-import sys
+import tempfile
+import threading
+import wave
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor, wait
 from contextlib import closing
+from itertools import islice
+from xml.sax.saxutils import escape
 
 import boto3
 import fitz  # PyMuPDF
+import numpy as np
+from botocore.config import Config
 from botocore.exceptions import BotoCoreError, ClientError
+from PIL import Image, ImageFilter, ImageEnhance
 
 AUX_FOLDER = './aux_files/'
 VIDEOS_FOLDER = './videos/'
+CACHE_FOLDER = './cache/'
+
+# Rendered pages and processed frames, reused across runs with the same visual settings. Pages are
+# kept as quickly compressed PNG, tens of KB for a text page; raw processed frames take 6.2 MB each,
+# so with the raw frame format the cache only holds decks of about 300 pages. Entries are evicted
+# least recently used first, so a deck bigger than the cache gets no hits at all on its next run:
+# raise the cap for such decks
+FRAME_CACHE_FOLDER = CACHE_FOLDER + 'frames/'
+FRAME_CACHE_MAX_BYTES = 2 * 1024 ** 3
+# PNG compression level of the cached pages: the fastest, still about 100 times smaller than raw pixels
+PAGE_CACHE_PNG_LEVEL = 1
+# Synthesized speech, reused across runs for unchanged text and voice settings. It is kept as PCM WAV,
+# 32 KB per second of 16 kHz Polly speech, so the cap holds about 37 hours of it: a minute of speech
+# for each page of several 800-page decks. Decks read in order get no hits once they exceed the cap
+AUDIO_CACHE_FOLDER = CACHE_FOLDER + 'audio/'
+AUDIO_CACHE_MAX_BYTES = 4 * 1024 ** 3
+
+# Size of the 9:16 output video
+VIDEO_WIDTH = 1080
+VIDEO_HEIGHT = 1920
+# Frame rate and audio sample rate of the output video
+VIDEO_FPS = 30
+AUDIO_SAMPLE_RATE = 44100
+# The blurred background is built at 1/BACKGROUND_DOWNSCALE of the video resolution
+BACKGROUND_DOWNSCALE = 4
+
+# Intermediate formats of the processed frames, by extension. PNG is the smallest on disk,
+# BMP and PPM are uncompressed, raw frames are memory-mapped packed RGB
+RAW_FRAME_EXT = '.rgb'
+FRAME_FORMATS = {'png': '.png', 'bmp': '.bmp', 'ppm': '.ppm', 'raw': RAW_FRAME_EXT}
+
+# Running headers and footers are text blocks in the top or bottom RUNNING_TEXT_MARGIN of the pages
+# that repeat on at least RUNNING_TEXT_MIN_SHARE of the pages, and on at least RUNNING_TEXT_MIN_PAGES
+RUNNING_TEXT_MARGIN = 0.15
+RUNNING_TEXT_MIN_SHARE = 0.5
+RUNNING_TEXT_MIN_PAGES = 3
+
+# Height of the GUI preview of a processed page; blur is never applied with a radius under
+# PREVIEW_MIN_BLUR pixels of the preview pyramid level it runs on
+PREVIEW_HEIGHT = 480
+PREVIEW_MIN_BLUR = 2
+
+# Amazon Polly voice
+POLLY_VOICE = 'Emma'
+POLLY_ENGINE = 'neural'
+POLLY_LANGUAGE = 'en-GB'
+# Polly audio is requested as PCM at POLLY_PCM_SAMPLE_RATE, the highest the neural voices support,
+# and kept as WAV, so durations come from sample counts
+POLLY_PCM_SAMPLE_RATE = 16000
+# A Polly request makes up to this many calls at once: the audio, and the speech marks of its word
+# timings or of the cuts of a batch
+POLLY_CALLS_PER_REQUEST = 2
+
+# Speech synthesis backends, see make_tts_backend
+TTS_BACKENDS = ('polly', 'edge-tts', 'local')
+EDGE_TTS_VOICE = 'en-GB-SoniaNeural'
+EDGE_TTS_RATE = '+0%'
+LOCAL_TTS_VOICE = 'en-gb'
+LOCAL_TTS_SAMPLE_RATE = 22050
+
+# Concurrent TTS requests: the limit starts at TTS_INITIAL_CONCURRENCY and adapts up to
+# TTS_MAX_CONCURRENCY; failed requests are retried with exponential backoff
+TTS_INITIAL_CONCURRENCY = 4
+TTS_MAX_CONCURRENCY = 16
+TTS_MAX_ATTEMPTS = 6
+TTS_BASE_BACKOFF = 0.5
+TTS_MAX_BACKOFF = 20
+THROTTLING_ERROR_CODES = ('ThrottlingException', 'TooManyRequestsException', 'Throttling')
+# Page text is split at sentence boundaries into chunks of at most TTS_CHUNK_CHARS, synthesized
+# concurrently; this also keeps every request under the Polly text limit
+TTS_CHUNK_CHARS = 1000
+# Consecutive pages with at most TTS_COALESCE_PAGE_CHARS of text each are synthesized in one request,
+# up to TTS_COALESCE_MAX_PAGES pages and TTS_CHUNK_CHARS of text, and cut apart at SSML marks
+TTS_COALESCE_PAGE_CHARS = 200
+TTS_COALESCE_MAX_PAGES = 20
+# Streamed audio is read from the service and piped into the page encoder in pieces of this size
+TTS_STREAM_CHUNK_BYTES = 16 * 1024
+
+# Subtitle cues hold at most SUBTITLE_MAX_CHARS of text and end at the end of sentences;
+# the subtitle stream is tagged with the ISO 639-2 code of the voice language
+SUBTITLE_MAX_CHARS = 42
+SUBTITLE_LANGUAGE = 'eng'
+# Leading and trailing silence, the samples under SILENCE_THRESHOLD_DB of full scale, is trimmed off
+# the speech of every page, all but SILENCE_KEEP seconds of it
+SILENCE_THRESHOLD_DB = -50
+SILENCE_KEEP = 0.2
+# Pages without text, like covers, diagrams and scans, are shown this long, with silence
+SILENT_PAGE_DURATION = 3.0
+
+# Polly clients by region, credentials and retry attempts, see get_polly_client
+_polly_clients = {}
+_polly_clients_lock = threading.Lock()
+
+# Number of processes used to rasterize the pages of a PDF
+EXTRACT_WORKERS = os.cpu_count() or 1
+# Number of pages a worker renders per task when extracting in parallel
+PAGE_CHUNK = 4
+
+
+class DiskCache:
+    """
+    Content-addressed files in a folder, bounded in size with least-recently-used eviction.
+    Every hit touches the entry, so modification times order the entries by last use.
+    """
 
+    def __init__(self, folder, max_bytes):
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(folder, exist_ok=True)
+        self._size = sum(entry.stat().st_size for entry in os.scandir(folder) if entry.is_file())
+
+    @staticmethod
+    def make_key(*parts):
+        return hashlib.sha256(repr(parts).encode()).hexdigest()
+
+    def lookup(self, key, ext):
+        """
+        Returns the path of the cached entry, or None on a miss.
+        """
+        paths = self.lookup_group(key, (ext,))
+        return paths and paths[0]
+
+    def lookup_group(self, key, exts):
+        """
+        Returns the paths of the entries of one key stored together under several extensions,
+        or None when any of them is missing. Counts as a single hit or miss.
+        """
+        paths = [os.path.join(self.folder, key + ext) for ext in exts]
+        try:
+            for path in paths:
+                os.utime(path)
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        return paths
+
+    def store(self, key, ext, write):
+        """
+        Stores an entry, written by write(file), and returns its path.
+        The entry is written to a temporary file first, so readers never see it half written.
+        """
+        path = os.path.join(self.folder, key + ext)
+        # Unique per call, as threads of one process may store the same key at once
+        fd, temp_path = tempfile.mkstemp(dir=self.folder, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as file:
+            write(file)
+        self._size += os.path.getsize(temp_path)
+        os.replace(temp_path, path)
+
+        if self._size > self.max_bytes:
+            self.evict()
+        return path
+
+    def evict(self):
+        """
+        Removes the least recently used entries until the cache fits in max_bytes.
+        """
+        entries = []
+        for entry in os.scandir(self.folder):
+            if entry.is_file() and not entry.name.endswith('.tmp'):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        entries.sort()
+
+        self._size = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if self._size <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            self._size -= size
 
-def extract_text_and_images(pdf_file):
-    data = []
-    doc = fitz.open(pdf_file)
 
-    for page_num in range(len(doc)):
-        page = doc.load_page(page_num)
+def _hash_object(doc, xref, digest):
+    """
+    Hashes a PDF object, and its stream if it has one.
+    """
+    digest.update(doc.xref_object(xref, compressed=True).encode())
+    if doc.xref_is_stream(xref):
+        digest.update(doc.xref_stream_raw(xref) or b'')
 
-        # Extract text
-        text = page.get_text()
-        # Remove leading and trailing whitespace
-        text = text.strip()
-        # Replace multiple consecutive line breaks with a single line break
-        text = text.replace('\n', ' ')
-        print(f"Text from Page {page_num + 1}:\n{text}\n")
-        data.append(text)
 
-        # Render page as an image
-        pix = page.get_pixmap()
+def page_hash(page):
+    """
+    Hashes what a page looks like: its content stream, geometry, images, form XObjects, fonts, graphics
+    state, shading and pattern resources, and the appearance of its annotations, which are rendered too.
+    Pages with equal hashes render to the same image, whichever document or page number they come from.
+    """
+    doc = page.parent
+    digest = hashlib.sha256()
+    digest.update(repr((tuple(page.rect), page.rotation)).encode())
+    digest.update(page.read_contents())
+    for xref in sorted({image[0] for image in page.get_images(full=True)}):
+        digest.update(doc.xref_stream_raw(xref) or b'')
+    for xref in sorted({xobject[0] for xobject in page.get_xobjects()}):
+        digest.update(doc.xref_stream_raw(xref) or b'')
+    for font in page.get_fonts(full=True):
+        digest.update(repr(font[1:6]).encode())
+    for resource in ('ExtGState', 'Shading', 'Pattern'):
+        kind, value = doc.xref_get_key(page.xref, 'Resources/' + resource)
+        if kind == 'xref':
+            value = doc.xref_object(int(value.split()[0]), compressed=True)
+        digest.update(value.encode())
+        for xref in re.findall(r'(\d+) 0 R', value):
+            _hash_object(doc, int(xref), digest)
+    for annot in page.annots():
+        digest.update(repr((annot.type[0], tuple(annot.rect), annot.flags)).encode())
+        kind, value = doc.xref_get_key(annot.xref, 'AP/N')
+        if kind == 'xref':
+            _hash_object(doc, int(value.split()[0]), digest)
+        else:
+            digest.update(value.encode())
+    return digest.hexdigest()
+
+
+def _page_ranges(page_count, chunk):
+    """
+    Splits the pages of a document into contiguous (start, stop) ranges of at most chunk pages.
+    """
+    return [(start, min(start + chunk, page_count)) for start in range(0, page_count, chunk)]
 
-        # Save the image
-        image_path = f"{AUX_FOLDER}page{page_num + 1}.png"
-        pix.save(image_path)
 
+def pixmap_to_image(pix):
+    """
+    Builds a PIL image straight from the pixmap samples, without a PNG round-trip.
+    Layouts Pillow can map directly (gray, RGBA) share the pixmap memory; RGB is unpacked in one copy.
+    """
+    mode = {1: 'L', 3: 'RGB', 4: 'RGBA'}[pix.n]
+    image = Image.frombuffer(mode, (pix.width, pix.height), pix.samples_mv, 'raw', mode, pix.stride, 1)
+    if image.readonly:
+        # The image maps the pixmap memory, so the pixmap must live as long as the image
+        image._pixmap = pix
+    return image
+
+
+def fitted_matrix(page, target_width=VIDEO_WIDTH, target_height=VIDEO_HEIGHT):
+    """
+    Returns the fitz matrix that rasterizes the page directly at the size it is fitted to on the canvas,
+    so no resampling is needed afterwards. Fitting also bounds the pixmap to the canvas, however large
+    the page is physically, so posters don't render at their full size.
+    """
+    rect = page.rect
+    if rect.is_empty:
+        return fitz.Identity
+
+    zoom = min(target_width / rect.width, target_height / rect.height)
+    return fitz.Matrix(zoom, zoom)
+
+
+def _render_page(page, target_width=VIDEO_WIDTH, target_height=VIDEO_HEIGHT):
+    """
+    Renders a page as a PIL image, at its final size on the video.
+    """
+    return pixmap_to_image(page.get_pixmap(matrix=fitted_matrix(page, target_width, target_height)))
+
+
+def normalize_text(text):
+    """
+    Collapses the whitespace of a text, so texts that read the same compare equal.
+    """
+    return ' '.join(text.split())
+
+
+def _running_text_key(block):
+    """
+    Returns the key under which a text block repeats across pages: its vertical position, rounded
+    to 2 points, and its normalized text with numbers masked, so "Page 3" and "Page 4" match.
+    """
+    y0, y1, text = block[1], block[3], block[4]
+    return round(y0 / 2), round(y1 / 2), re.sub(r'\d+', '#', normalize_text(text))
+
+
+def _is_in_margin(page, block):
+    """
+    Tells whether a block lies in the top or bottom margin band of the page.
+    """
+    height = page.rect.height
+    return block[3] <= page.rect.y0 + height * RUNNING_TEXT_MARGIN or \
+        block[1] >= page.rect.y1 - height * RUNNING_TEXT_MARGIN
+
+
+def _text_blocks(page):
+    return [block for block in page.get_text('blocks') if block[6] == 0]
+
+
+def find_running_text(pdf_file):
+    """
+    Finds running headers, footers and page numbers: text blocks in the page margins that repeat at
+    the same position on at least RUNNING_TEXT_MIN_SHARE of the pages, and on RUNNING_TEXT_MIN_PAGES.
+    Returns the keys of those blocks, to be removed from the narration.
+    """
+    pages_by_key = {}
+    with fitz.open(pdf_file) as doc:
+        page_count = len(doc)
+        blocks = []
+        for page in doc:
+            for block in _text_blocks(page):
+                if _is_in_margin(page, block):
+                    key = _running_text_key(block)
+                    pages_by_key.setdefault(key, set()).add(page.number)
+                    blocks.append((key, block[4]))
+
+    min_pages = max(RUNNING_TEXT_MIN_PAGES, page_count * RUNNING_TEXT_MIN_SHARE)
+    running_text = frozenset(key for key, pages in pages_by_key.items() if len(pages) >= min_pages)
+
+    saved_chars = sum(len(normalize_text(text)) for key, text in blocks if key in running_text)
+    print(f"Running headers/footers: {len(running_text)} found, {saved_chars} characters removed from narration")
+    return running_text
+
+
+def _page_text(page, running_text=None):
+    """
+    Extracts the text of a page, leaving out the blocks found by find_running_text.
+    """
+    if not running_text:
+        return page.get_text()
+
+    return '\n'.join(block[4] for block in _text_blocks(page)
+                     if not (_is_in_margin(page, block) and _running_text_key(block) in running_text))
+
+
+def _extract_page(page, save_pages=False, cache=None, running_text=None):
+    """
+    Extracts the text of a page and renders it as an image. Returns the text and the PIL image.
+    With a cache, a page that was rendered before at the same resolution is loaded instead.
+    """
+    page_num = page.number
+
+    # Extract text
+    text = _page_text(page, running_text)
+    # Remove leading and trailing whitespace
+    text = text.strip()
+    # Replace multiple consecutive line breaks with a single line break
+    text = text.replace('\n', ' ')
+    print(f"Text from Page {page_num + 1}:\n{text}\n")
+
+    if cache is None:
+        image = _render_page(page)
+    else:
+        digest = page_hash(page)
+        key = DiskCache.make_key('page', digest, VIDEO_WIDTH, VIDEO_HEIGHT)
+        cached_path = cache.lookup(key, '.png')
+        if cached_path:
+            image = Image.open(cached_path)
+            image.load()
+        else:
+            image = _render_page(page)
+            cache.store(key, '.png', lambda file: image.save(file, 'PNG', compress_level=PAGE_CACHE_PNG_LEVEL))
+        # Lets the later stages find their own cache entries for this page
+        image.info['page_hash'] = digest
+
+    if save_pages:
+        # Save the image, for debugging only
+        image_path = f"{AUX_FOLDER}page{page_num + 1}.png"
+        image.save(image_path)
         print(f"Page {page_num + 1} saved as {image_path}")
 
+    return text, image
+
+
+def _extract_page_range(pdf_file, start, stop, save_pages=False, cache=None, running_text=None):
+    """
+    Extracts pages [start, stop) from its own fitz document, as (page_index, text, frame) tuples.
+    Also returns the cache hits and misses of the range, since a worker process counts them
+    on its own copy of the cache.
+    """
+    data = []
+    doc = fitz.open(pdf_file)
+    hits, misses = (cache.hits, cache.misses) if cache is not None else (0, 0)
+
+    for page_num in range(start, stop):
+        text, frame = _extract_page(doc.load_page(page_num), save_pages, cache, running_text)
+        data.append((page_num, text, frame))
+
     doc.close()
+    if cache is None:
+        return data, 0, 0
+    return data, cache.hits - hits, cache.misses - misses
+
+
+def iter_pages(pdf_file, workers=1, chunk=PAGE_CHUNK, save_pages=False, cache=None, running_text=None):
+    """
+    Yields (page_index, text, frame) for every page of the PDF, in page order, one page at a time.
+    The frame is the rendered page as a PIL image; page PNGs are only written when save_pages is set.
+    Rendered pages are looked up in and added to the cache, if one is given.
+    Text blocks found by find_running_text are left out of the texts.
+    With more than one worker, ranges of chunk pages are rendered ahead by a process pool, but never
+    more than two ranges per worker, so memory and disk use stay bounded however long the PDF is.
+    """
+    with fitz.open(pdf_file) as doc:
+        page_count = len(doc)
+
+        if workers <= 1 or page_count <= 1:
+            for page_num in range(page_count):
+                text, frame = _extract_page(doc.load_page(page_num), save_pages, cache, running_text)
+                yield page_num, text, frame
+            return
+
+    chunk = max(1, min(chunk, -(-page_count // workers)))
+    ranges = iter(_page_ranges(page_count, chunk))
+    executor = ProcessPoolExecutor(max_workers=workers)
+    try:
+        pending = deque(executor.submit(_extract_page_range, pdf_file, start, stop, save_pages, cache, running_text)
+                        for start, stop in islice(ranges, workers * 2))
+        while pending:
+            results, hits, misses = pending.popleft().result()
+            if cache is not None:
+                cache.hits += hits
+                cache.misses += misses
+            for start, stop in islice(ranges, 1):
+                pending.append(executor.submit(_extract_page_range, pdf_file, start, stop, save_pages, cache, running_text))
+            yield from results
+    finally:
+        # Stop rendering ahead if the consumer gives up early
+        executor.shutdown(cancel_futures=True)
+
+
+def extract_text_and_images(pdf_file, workers=1):
+    """
+    Extracts the text of every page and saves every page as an image.
+    Returns the texts in page order.
+    """
+    data = [text for _, text, _ in iter_pages(pdf_file, workers, save_pages=True)]
+
     print_text_data(data)
     return data
 
@@ -50,9 +467,6 @@ def print_text_data(data):
         print("{} - index - Line{}: {}".format((count - 1), count, line.strip()))
 
 
-from PIL import Image, ImageFilter, ImageEnhance
-
-
 def scale_image(image, target_width, target_height):
     """
     Scales the image while preserving aspect ratio to fit within target dimensions.
@@ -101,11 +515,9 @@ def apply_blur_and_darken(image, blur_radius, darken_factor):
 def overlay_images(original_image, overlay_image):
     """
     Overlays the original image over the overlay image with scaling to fit.
+    An overlay that was already rendered at its fitted size is used as is.
     """
-    overlay_width, overlay_height = overlay_image.size
-    overlay_ratio = min(original_image.size[0] / overlay_width, original_image.size[1] / overlay_height)
-    overlay_size = (int(overlay_width * overlay_ratio), int(overlay_height * overlay_ratio))
-    scaled_overlay = overlay_image.resize(overlay_size, Image.LANCZOS)
+    scaled_overlay = fit_image(overlay_image, original_image.width, original_image.height)
 
     # Create a mask based on the alpha channel of the scaled overlay image
     if scaled_overlay.mode in ('RGBA', 'LA') or (scaled_overlay.mode == 'P' and 'transparency' in scaled_overlay.info):
@@ -122,44 +534,317 @@ def overlay_images(original_image, overlay_image):
     return result
 
 
-def process_image(input_image_path, output_image_path, blur_radius=8, darken_factor=0.5):
+def fit_image(image, target_width, target_height):
+    """
+    Scales the image to fit within target dimensions, preserving aspect ratio.
+    An image that was already rendered at its fitted size is returned as is.
+    """
+    width, height = image.size
+    fits = width <= target_width and height <= target_height
+    if fits and (width == target_width or height == target_height):
+        return image
+
+    ratio = min(target_width / width, target_height / height)
+    return image.resize((int(width * ratio), int(height * ratio)), Image.LANCZOS)
+
+
+def brightness_lut(darken_factor):
+    """
+    Returns the lookup table that applies a brightness factor in one pass, like ImageEnhance.Brightness.
+    """
+    return np.clip(np.arange(256) * darken_factor + 0.5, 0, 255).astype(np.uint8).tolist()
+
+
+def make_background(image, blur_radius, darken_factor, target_width=VIDEO_WIDTH, target_height=VIDEO_HEIGHT,
+                    downscale=BACKGROUND_DOWNSCALE):
+    """
+    Builds the blurred and darkened background that covers the target dimensions.
+    The image is cropped and scaled in one resize, then blurred and darkened at 1/downscale of the
+    target resolution, and upsampled once; since the result is blurred, the lost detail is not visible.
+    A blur_radius smaller than downscale would not hide it, so such backgrounds are built at full resolution.
+    """
+    if blur_radius < downscale:
+        downscale = 1
+    small_width = max(1, target_width // downscale)
+    small_height = max(1, target_height // downscale)
+
+    # Source box that covers the small canvas, centered on the image
+    width, height = image.size
+    scale = max(small_width / width, small_height / height)
+    box_width, box_height = min(width, small_width / scale), min(height, small_height / scale)
+    left, top = (width - box_width) / 2, (height - box_height) / 2
+
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+    # The resampling of scale_image at full resolution, so a sharp background stays as sharp
+    resample = Image.LANCZOS if downscale == 1 else Image.BOX
+    background = image.resize((small_width, small_height), resample,
+                              box=(left, top, left + box_width, top + box_height))
+
+    if blur_radius:
+        background = background.filter(ImageFilter.GaussianBlur(radius=blur_radius / downscale))
+    if darken_factor != 1:
+        background = background.point(brightness_lut(darken_factor) * 3)
+
+    if background.size == (target_width, target_height):
+        return background
+    return background.resize((target_width, target_height), Image.BILINEAR)
+
+
+class FrameCompositor:
+    """
+    Composites pages over their backgrounds with NumPy, reusing one canvas buffer for every frame.
+    """
+
+    def __init__(self, width=VIDEO_WIDTH, height=VIDEO_HEIGHT):
+        self.width = width
+        self.height = height
+        self.canvas = np.empty((height, width, 3), dtype=np.uint8)
+
+    def composite(self, page_image, background):
+        """
+        Centers the page over the background. Returns a new RGB image.
+        """
+        self.canvas[...] = np.asarray(background)
+
+        page_image = fit_image(page_image, self.width, self.height)
+        left = (self.width - page_image.width) // 2
+        top = (self.height - page_image.height) // 2
+        region = self.canvas[top:top + page_image.height, left:left + page_image.width]
+
+        if page_image.mode in ('RGBA', 'LA') or (page_image.mode == 'P' and 'transparency' in page_image.info):
+            page = np.asarray(page_image.convert('RGBA'), dtype=np.uint16)
+            alpha = page[..., 3:]
+            region[...] = (page[..., :3] * alpha + region * (255 - alpha) + 127) // 255
+        else:
+            region[...] = np.asarray(page_image if page_image.mode == 'RGB' else page_image.convert('RGB'))
+
+        return Image.fromarray(self.canvas)
+
+
+class PagePreview:
+    """
+    Renders previews of a processed page fast enough to follow the blur and brightness sliders.
+    The page is rendered once at preview size, and its cover background is kept as a pyramid of
+    halved images: each blur radius is applied on the smallest level where it still spans a few
+    pixels, then upsampled, and the result is kept for when the slider comes back to that radius.
+    """
+
+    def __init__(self, pdf_file, page_index=0, height=PREVIEW_HEIGHT):
+        width = round(height * VIDEO_WIDTH / VIDEO_HEIGHT)
+        self.scale = height / VIDEO_HEIGHT
+
+        with fitz.open(pdf_file) as doc:
+            self.page_count = len(doc)
+            page = doc.load_page(page_index)
+            self.page_image = _render_page(page, width, height)
+
+        self.compositor = FrameCompositor(width, height)
+        self.pyramid = [make_background(self.page_image, 0, 1, width, height, downscale=1)]
+        while min(self.pyramid[-1].size) >= 32:
+            self.pyramid.append(self.pyramid[-1].reduce(2))
+        self._blurred = {}
+
+    def blurred_background(self, blur_radius):
+        """
+        Returns the background blurred by blur_radius, given in pixels of the video.
+        """
+        blurred = self._blurred.get(blur_radius)
+        if blurred is None:
+            radius = blur_radius * self.scale
+            level = 0
+            while level + 1 < len(self.pyramid) and radius / 2 ** (level + 1) >= PREVIEW_MIN_BLUR:
+                level += 1
+            blurred = self.pyramid[level]
+            if radius:
+                blurred = blurred.filter(ImageFilter.GaussianBlur(radius=radius / 2 ** level))
+            blurred = blurred.resize(self.pyramid[0].size, Image.BILINEAR)
+            self._blurred[blur_radius] = blurred
+        return blurred
+
+    def render(self, blur_radius, darken_factor):
+        """
+        Returns the preview of the processed page, as an RGB image.
+        """
+        background = self.blurred_background(blur_radius).point(brightness_lut(darken_factor) * 3)
+        return self.compositor.composite(self.page_image, background)
+
+
+def frame_path(index, frame_format='png'):
+    """
+    Returns the path of the processed frame of a page, in one of FRAME_FORMATS.
+    """
+    return f"{AUX_FOLDER}page{index + 1}_processed{FRAME_FORMATS[frame_format]}"
+
+
+def save_frame(image, path):
+    """
+    Saves a frame. Raw frames are written as packed rgb24 pixels, with no encoding at all.
+    """
+    if path.endswith(RAW_FRAME_EXT):
+        np.asarray(image.convert('RGB')).tofile(path)
+    else:
+        image.save(path)
+
+
+def load_frame(path, width=VIDEO_WIDTH, height=VIDEO_HEIGHT):
+    """
+    Opens a saved frame. Raw frames are mapped into memory rather than read and decoded.
+    """
+    if path.endswith(RAW_FRAME_EXT):
+        frame = np.memmap(path, dtype=np.uint8, mode='r', shape=(height, width, 3))
+        return Image.frombuffer('RGB', (width, height), frame, 'raw', 'RGB', 0, 1)
+    return Image.open(path)
+
+
+def ffmpeg_frame_args(path, width=VIDEO_WIDTH, height=VIDEO_HEIGHT):
+    """
+    Returns the ffmpeg input arguments that loop a saved frame as a still video.
+    Raw frames are read by the rawvideo demuxer, so ffmpeg has nothing to decode either.
+    """
+    if path.endswith(RAW_FRAME_EXT):
+        return ['-stream_loop', '-1', '-f', 'rawvideo', '-pix_fmt', 'rgb24', '-s', f'{width}x{height}',
+                '-framerate', str(VIDEO_FPS), '-i', path]
+    return ['-loop', '1', '-i', path]
+
+
+def ffmpeg_frame_input(path, width=VIDEO_WIDTH, height=VIDEO_HEIGHT):
+    return ' '.join(ffmpeg_frame_args(path, width, height))
+
+
+def process_image(input_image, output_image_path, blur_radius=8, darken_factor=0.5, compositor=None, cache=None):
     """
-    Processes the input image and saves the resulting image.
+    Processes the input image (a PIL image or a path) and saves the resulting image, see save_frame.
+    Pass the same compositor for every page to reuse its buffers. With a cache, a page that was
+    processed before with the same settings is copied from the cache instead.
     """
     # Open input image
-    input_image = Image.open(input_image_path)
+    if isinstance(input_image, str):
+        input_image = Image.open(input_image)
 
-    # Scale the image to fit 1080p by 1920p
-    scaled_image = scale_image(input_image, 1080, 1920)
+    if compositor is None:
+        compositor = FrameCompositor()
 
-    # Crop the resulting image to a 1080p by 1920p rectangle from the center
-    cropped_image = crop_image(scaled_image, 1080, 1920)
+    key = None
+    digest = input_image.info.get('page_hash')
+    if cache is not None and digest:
+        ext = os.path.splitext(output_image_path)[1]
+        key = DiskCache.make_key('frame', digest, compositor.width, compositor.height, blur_radius, darken_factor)
+        cached_path = cache.lookup(key, ext)
+        if cached_path:
+            shutil.copyfile(cached_path, output_image_path)
+            return
 
-    # Apply blur effect and darken the image
-    processed_image = apply_blur_and_darken(cropped_image, blur_radius, darken_factor)
+    # Build the blurred and darkened background at low resolution
+    background = make_background(input_image, blur_radius, darken_factor, compositor.width, compositor.height)
 
-    # Overlay the original image over the processed image
-    final_image = overlay_images(processed_image, input_image)
+    # Overlay the original image over the background
+    final_image = compositor.composite(input_image, background)
 
     # Save the resulting image
-    final_image.save(output_image_path)
+    save_frame(final_image, output_image_path)
 
+    if key:
+        with open(output_image_path, 'rb') as saved:
+            cache.store(key, ext, lambda file: shutil.copyfileobj(saved, file))
 
-def trim_audio(in_audio_path, out_audio_path):
-    trim_audio_clip = 'ffmpeg.exe -y -i ' + in_audio_path + ' -af silenceremove=start_periods=1:start_silence=0.2:start_threshold=-50dB,areverse,silenceremove=start_periods=1:start_silence=0.2:start_threshold=-50dB,areverse ' + out_audio_path
 
-    subprocess.check_output(trim_audio_clip, shell=True)
+def silence_bounds(samples, sample_rate, threshold_db=SILENCE_THRESHOLD_DB, keep=SILENCE_KEEP):
+    """
+    Returns the bounds, start and stop, of 16-bit samples without their leading and trailing silence,
+    keeping keep seconds of each. The trim of ffmpeg's silenceremove filter at the same settings, without
+    decoding the audio in ffmpeg.
+    """
+    threshold = 32768 * 10 ** (threshold_db / 20)
+    loud = np.flatnonzero((samples > threshold) | (samples < -threshold))
+    if not len(loud):
+        return 0, 0
 
+    margin = round(keep * sample_rate)
+    return max(0, int(loud[0]) - margin), min(len(samples), int(loud[-1]) + 1 + margin)
 
-def make_audio_polly(text, filepath, polly):
+
+def trim_wav(in_audio_path, out_audio_path):
+    """
+    Trims the silence off both ends of a mono 16-bit WAV file, see silence_bounds.
+    Returns the duration of the trimmed audio, and where it starts in the original, in seconds.
+    """
+    with wave.open(in_audio_path, 'rb') as file:
+        sample_rate = file.getframerate()
+        samples = pcm_samples(file.readframes(file.getnframes()))
+
+    start, stop = silence_bounds(samples, sample_rate)
+    write_wav(out_audio_path, samples[start:stop], sample_rate)
+    return (stop - start) / sample_rate, start / sample_rate
+
+
+def audio_cache_key(text, voice, engine, language, rate=None, output_format='mp3', word_timings=None):
+    """
+    Returns the audio cache key of a TTS request: everything that changes the synthesized audio,
+    and whether its word timings were requested, for backends that only get them on request.
+    """
+    return DiskCache.make_key('audio', normalize_text(text), voice, engine, language, rate, output_format,
+                              word_timings)
+
+
+def split_text(text, max_chars=TTS_CHUNK_CHARS):
+    """
+    Splits text into chunks of at most max_chars, at sentence boundaries where possible.
+    Sentences longer than max_chars are split between words.
+    """
+    text = normalize_text(text)
+    if len(text) <= max_chars:
+        return [text]
+
+    pieces = []
+    for sentence in re.split(r'(?<=[.!?;:])\s+', text):
+        while len(sentence) > max_chars:
+            cut = sentence.rfind(' ', 0, max_chars + 1)
+            if cut <= 0:
+                cut = max_chars
+            pieces.append(sentence[:cut])
+            sentence = sentence[cut:].lstrip()
+        if sentence:
+            pieces.append(sentence)
+
+    chunks = [pieces[0]]
+    for piece in pieces[1:]:
+        if len(chunks[-1]) + 1 + len(piece) <= max_chars:
+            chunks[-1] += ' ' + piece
+        else:
+            chunks.append(piece)
+    return chunks
+
+
+class TTSError(Exception):
+    """
+    A speech synthesis request failed. Transient failures are worth retrying;
+    throttled ones also mean too many requests are in flight.
+    """
+
+    def __init__(self, message, transient=False, throttled=False):
+        super().__init__(message)
+        self.transient = transient or throttled
+        self.throttled = throttled
+
+
+def polly_request(polly, on_chunk=None, **params):
+    """
+    Sends one synthesize_speech request with the configured voice and returns the bytes of its stream.
+    With on_chunk, the stream is passed to on_chunk(bytes) in pieces as it arrives instead.
+    """
     try:
         # Request speech synthesis
-        response = polly.synthesize_speech(Engine="neural", LanguageCode='en-GB', Text=text, OutputFormat="mp3",
-                                           VoiceId="Emma")
-    except (BotoCoreError, ClientError) as error:
+        response = polly.synthesize_speech(Engine=POLLY_ENGINE, LanguageCode=POLLY_LANGUAGE, VoiceId=POLLY_VOICE,
+                                           **params)
+    except ClientError as error:
         # The service returned an error
-        print(error)
-        sys.exit(-1)
+        code = error.response.get('Error', {}).get('Code')
+        status = error.response.get('ResponseMetadata', {}).get('HTTPStatusCode', 0)
+        raise TTSError(str(error), transient=status >= 500, throttled=code in THROTTLING_ERROR_CODES) from error
+    except BotoCoreError as error:
+        # The request did not get through, e.g. a connection error
+        raise TTSError(str(error), transient=True) from error
 
     # Access the audio stream from the response
     if "AudioStream" in response:
@@ -169,33 +854,750 @@ def make_audio_polly(text, filepath, polly):
         # at the end of the with statement's scope.
         with closing(response["AudioStream"]) as stream:
             try:
-                # Write the audio stream to the output file
-                with open(filepath, "wb") as file:
-                    file.write(stream.read())
-            except IOError as error:
-                # Could not write to file
-                print(error)
-                sys.exit(-1)
+                if on_chunk is None:
+                    return stream.read()
+                for chunk in iter(lambda: stream.read(TTS_STREAM_CHUNK_BYTES), b''):
+                    on_chunk(chunk)
+            except BotoCoreError as error:
+                # The connection dropped while reading the audio
+                raise TTSError(str(error), transient=True) from error
     else:
         # The response didn't contain audio data
-        print("Could not stream audio")
-        sys.exit(-1)
+        raise TTSError("Could not stream audio", transient=True)
 
 
-def merge_image_audio(image_in, audio_in, video_out, fade_duration):
-    audio_in_2 = audio_in + 'hax.mp3'
+def make_audio_polly(text, filepath, polly):
+    pcm = polly_request(polly, Text=text, OutputFormat="pcm", SampleRate=str(POLLY_PCM_SAMPLE_RATE))
+    try:
+        # Write the audio stream to the output file
+        write_wav(filepath, pcm_samples(pcm), POLLY_PCM_SAMPLE_RATE)
+    except IOError as error:
+        # Could not write to file
+        raise TTSError(str(error)) from error
+
 
-    trim_audio(audio_in, audio_in_2)
+def pcm_samples(pcm):
+    """
+    Returns the samples of mono 16-bit little-endian PCM bytes, without copying them.
+    """
+    return np.frombuffer(pcm, dtype='<i2', count=len(pcm) // 2)
 
-    duration = get_length(audio_in_2)
-    # duration = get_length(audio_in)
+
+def marked_ssml(texts):
+    """
+    Returns the SSML of consecutive texts, each one preceded by a mark named after its index.
+    """
+    return '<speak>' + ' '.join(f'<mark name="{n}"/>{escape(text)}' for n, text in enumerate(texts)) + '</speak>'
+
+
+def parse_speech_marks(marks):
+    """
+    Parses the newline-delimited JSON of Polly speech marks.
+    """
+    return [json.loads(line) for line in marks.decode().splitlines() if line.strip()]
+
+
+def marks_to_words(marks, end):
+    """
+    Returns the word timings, [start, end, word] in seconds, of Polly word speech marks.
+    Polly only marks where words start: a word lasts until the next one, the last one until end.
+    """
+    starts = [mark['time'] / 1000 for mark in marks]
+    return [[start, word_end, mark['value']] for start, word_end, mark in zip(starts, starts[1:] + [end], marks)]
+
+
+def split_pcm_at_marks(pcm, marks, count, sample_rate):
+    """
+    Cuts mono 16-bit PCM into the audio of count texts, at the SSML speech marks made by marked_ssml.
+    Returns (samples, word timings) per text, with the timings relative to the start of the text.
+    """
+    marks = parse_speech_marks(marks)
+    starts = {int(mark['value']): mark['time'] for mark in marks if mark['type'] == 'ssml'}
+    if len(starts) != count:
+        raise TTSError(f"Expected {count} speech marks, got {len(starts)}")
+
+    samples = pcm_samples(pcm)
+    bounds = [min(len(samples), round(starts[n] * sample_rate / 1000)) for n in range(count)] + [len(samples)]
+    word_marks = [mark for mark in marks if mark['type'] == 'word']
+
+    texts = []
+    for n in range(count):
+        start, end = bounds[n] / sample_rate, bounds[n + 1] / sample_rate
+        words = marks_to_words([mark for mark in word_marks if start <= mark['time'] / 1000 < end], end)
+        texts.append((samples[bounds[n]:bounds[n + 1]],
+                      [[word_start - start, word_end - start, word] for word_start, word_end, word in words]))
+    return texts
+
+
+class AdaptiveConcurrency:
+    """
+    Limits the TTS requests in flight with AIMD: the limit grows by one for every limit's worth of
+    successful requests, and is halved whenever the service throttles.
+    """
+
+    def __init__(self, initial, maximum, minimum=1):
+        self.limit = float(initial)
+        self.maximum = maximum
+        self.minimum = minimum
+        self.in_flight = 0
+        self._condition = asyncio.Condition()
+
+    async def __aenter__(self):
+        async with self._condition:
+            await self._condition.wait_for(lambda: self.in_flight < int(self.limit))
+            self.in_flight += 1
+
+    async def __aexit__(self, exc_type, exc, tb):
+        async with self._condition:
+            self.in_flight -= 1
+            self._condition.notify_all()
+
+    def succeeded(self):
+        self.limit = min(self.maximum, self.limit + 1 / self.limit)
+
+    def throttled(self):
+        self.limit = max(self.minimum, self.limit / 2)
+        print(f"TTS throttled, concurrency limit down to {int(self.limit)}")
+
+
+class TTSBackend:
+    """
+    A speech synthesis backend. synthesize() writes the speech of a text to a mono 16-bit WAV file and
+    returns its word timings, [start, end, word] in seconds, or None when the backend has none;
+    join() joins the files of consecutive chunks into one track. Backends that can synthesize several
+    texts in one request and split the audio apart again set supports_batch and implement synthesize_batch(),
+    which returns the word timings of every text. Backends that can hand out the audio while it is being
+    synthesized set stream_input, the ffmpeg input options of the audio, and implement stream().
+    calls counts the calls to the speech service, as a request may make several.
+    """
+    name = None
+    audio_ext = '.wav'
+    supports_batch = False
+    stream_input = None
+    calls = 0
+
+    def cache_key(self, text):
+        raise NotImplementedError
+
+    async def synthesize(self, text, filepath):
+        raise NotImplementedError
+
+    async def synthesize_batch(self, texts, filepaths):
+        raise NotImplementedError
+
+    async def stream(self, text, words):
+        """
+        Yields the audio of a text in pieces as they are synthesized, and appends its word timings to words.
+        """
+        raise NotImplementedError
+        yield
+
+    def join(self, chunk_paths, filepath):
+        join_wav_files(chunk_paths, filepath)
+
+    def close(self):
+        pass
+
+
+class PollyBackend(TTSBackend):
+    """
+    Amazon Polly. The blocking boto3 calls run on a pool of threads, and a request makes up to
+    POLLY_CALLS_PER_REQUEST of them at once, so the pool has that many threads per request in flight.
+    Word timings come from word speech marks, requested alongside the audio when word_timings is set.
+    A batch is one SSML request with a mark before every text, sent twice: once for the PCM audio
+    and once for the speech marks, which is where the audio is cut into WAV files.
+    """
+    name = 'polly'
+    supports_batch = True
+    stream_input = f'-f s16le -ar {POLLY_PCM_SAMPLE_RATE} -ac 1'
+
+    def __init__(self, polly, max_concurrency=TTS_MAX_CONCURRENCY, word_timings=True):
+        self.polly = polly
+        self.word_timings = word_timings
+        self.executor = ThreadPoolExecutor(max_workers=max_concurrency * POLLY_CALLS_PER_REQUEST)
+
+    def cache_key(self, text):
+        # Audio cached without its timings must not stand in for a request that wants them
+        return audio_cache_key(text, POLLY_VOICE, POLLY_ENGINE, POLLY_LANGUAGE, POLLY_PCM_SAMPLE_RATE, 'wav',
+                               self.word_timings)
+
+    def _call(self, function, *args):
+        """
+        Runs a blocking Polly call on the pool of threads, and counts it.
+        """
+        self.calls += 1
+        return asyncio.get_running_loop().run_in_executor(self.executor, function, *args)
+
+    async def synthesize(self, text, filepath):
+        audio = self._call(make_audio_polly, text, filepath, self.polly)
+        if not self.word_timings:
+            await audio
+            return None
+
+        _, marks = await asyncio.gather(audio, self._call(lambda: polly_request(
+            self.polly, Text=text, OutputFormat='json', SpeechMarkTypes=['word'])))
+        return marks_to_words(parse_speech_marks(marks), wav_duration(filepath))
+
+    async def stream(self, text, words):
+        loop = asyncio.get_running_loop()
+        marks = None
+        if self.word_timings:
+            marks = self._call(lambda: polly_request(
+                self.polly, Text=text, OutputFormat='json', SpeechMarkTypes=['word']))
+
+        # The audio is read on a worker thread, which hands the pieces over to the event loop
+        chunks = asyncio.Queue()
+
+        def read():
+            try:
+                polly_request(self.polly, lambda chunk: loop.call_soon_threadsafe(chunks.put_nowait, chunk),
+                              Text=text, OutputFormat='pcm', SampleRate=str(POLLY_PCM_SAMPLE_RATE))
+            finally:
+                loop.call_soon_threadsafe(chunks.put_nowait, None)
+
+        reader = self._call(read)
+        length = 0
+        while (chunk := await chunks.get()) is not None:
+            length += len(chunk)
+            yield chunk
+        await reader
+
+        if marks is not None:
+            words += marks_to_words(parse_speech_marks(await marks), length / 2 / POLLY_PCM_SAMPLE_RATE)
+
+    async def synthesize_batch(self, texts, filepaths):
+        ssml = marked_ssml(texts)
+        marks, pcm = await asyncio.gather(
+            self._call(lambda: polly_request(
+                self.polly, Text=ssml, TextType='ssml', OutputFormat='json', SpeechMarkTypes=['ssml', 'word'])),
+            self._call(lambda: polly_request(
+                self.polly, Text=ssml, TextType='ssml', OutputFormat='pcm', SampleRate=str(POLLY_PCM_SAMPLE_RATE))))
+
+        timings = []
+        for (samples, words), filepath in zip(split_pcm_at_marks(pcm, marks, len(texts), POLLY_PCM_SAMPLE_RATE),
+                                              filepaths):
+            write_wav(filepath, samples, POLLY_PCM_SAMPLE_RATE)
+            timings.append(words)
+        return timings
+
+    def close(self):
+        self.executor.shutdown(cancel_futures=True)
+
+
+class EdgeTTSBackend(TTSBackend):
+    """
+    Microsoft Edge online TTS, through the edge-tts package. The service only sends MP3,
+    which is decoded to WAV once, as soon as it has arrived. Word timings come from the boundary
+    events of the stream, sentence boundaries with the edge-tts versions that default to them.
+    """
+    name = 'edge-tts'
+    stream_input = '-f mp3'
+
+    def __init__(self, voice=EDGE_TTS_VOICE, rate=EDGE_TTS_RATE):
+        import edge_tts
+        self.edge_tts = edge_tts
+        self.voice = voice
+        self.rate = rate
+
+    def cache_key(self, text):
+        return audio_cache_key(text, self.voice, self.name, None, self.rate, 'wav')
+
+    async def stream(self, text, words):
+        communicate = self.edge_tts.Communicate(text, self.voice, rate=self.rate)
+        self.calls += 1
+        try:
+            async for chunk in communicate.stream():
+                if chunk["type"] == "audio":
+                    yield chunk["data"]
+                elif chunk["type"] in ("WordBoundary", "SentenceBoundary"):
+                    # Offsets and durations are in ticks of 100 ns
+                    start = chunk["offset"] / 10 ** 7
+                    words.append([start, start + chunk["duration"] / 10 ** 7, chunk["text"]])
+        except Exception as error:
+            # Network and service errors, edge-tts has no common base class for them
+            raise TTSError(str(error), transient=True) from error
+
+    async def synthesize(self, text, filepath):
+        mp3_path = filepath + '.mp3'
+        words = []
+        try:
+            with open(mp3_path, "wb") as file:
+                async for chunk in self.stream(text, words):
+                    file.write(chunk)
+        except IOError as error:
+            # Could not write to file
+            raise TTSError(str(error)) from error
+
+        decode = await asyncio.create_subprocess_shell(
+            # The format is given, since chunk files are named .part<n> rather than .wav
+            'ffmpeg.exe -y -v error -i "' + mp3_path + '" -ac 1 -c:a pcm_s16le -f wav "' + filepath + '"',
+            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        _, error = await decode.communicate()
+        os.remove(mp3_path)
+        if decode.returncode:
+            raise TTSError(f"Could not decode edge-tts audio: {error.decode(errors='replace')}")
+        return words or None
+
+
+class LocalBackend(TTSBackend):
+    """
+    Offline speech, for running and load-testing the pipeline without network access.
+    Uses espeak-ng when it is installed; otherwise generates deterministic synthetic speech:
+    a tone burst per word, with the pauses and the pace of real speech. Only synthetic speech has
+    word timings.
+    """
+    name = 'local'
+
+    def __init__(self, voice=LOCAL_TTS_VOICE):
+        self.voice = voice
+        self.espeak = shutil.which('espeak-ng')
+        # espeak-ng streams a WAV file to its standard output
+        self.stream_input = '-f wav' if self.espeak else f'-f s16le -ar {LOCAL_TTS_SAMPLE_RATE} -ac 1'
+
+    def cache_key(self, text):
+        return audio_cache_key(text, self.voice, self.espeak and 'espeak-ng' or 'synthetic', None, None, 'wav')
+
+    async def synthesize(self, text, filepath):
+        if not self.espeak:
+            words = []
+            write_wav(filepath, synthetic_speech(text, words=words), LOCAL_TTS_SAMPLE_RATE)
+            return words
+
+        process = await asyncio.create_subprocess_exec(self.espeak, '-v', self.voice, '-w', filepath, '--stdin',
+                                                       stdin=subprocess.PIPE, stdout=subprocess.DEVNULL,
+                                                       stderr=subprocess.PIPE)
+        _, error = await process.communicate(text.encode())
+        if process.returncode:
+            raise TTSError(f"espeak-ng failed: {error.decode(errors='replace')}")
+        return None
+
+    async def stream(self, text, words):
+        if not self.espeak:
+            pcm = np.asarray(synthetic_speech(text, words=words), dtype='<i2').tobytes()
+            for start in range(0, len(pcm), TTS_STREAM_CHUNK_BYTES):
+                yield pcm[start:start + TTS_STREAM_CHUNK_BYTES]
+            return
+
+        process = await asyncio.create_subprocess_exec(self.espeak, '-v', self.voice, '--stdout', '--stdin',
+                                                       stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                                       stderr=subprocess.PIPE)
+        # Page text is at most TTS_CHUNK_CHARS, well within the pipe buffer
+        process.stdin.write(text.encode())
+        process.stdin.close()
+        while chunk := await process.stdout.read(TTS_STREAM_CHUNK_BYTES):
+            yield chunk
+        error = await process.stderr.read()
+        if await process.wait():
+            raise TTSError(f"espeak-ng failed: {error.decode(errors='replace')}")
+
+
+def write_wav(filepath, samples, sample_rate):
+    """
+    Writes mono 16-bit samples to a WAV file.
+    """
+    with wave.open(filepath, 'wb') as file:
+        file.setnchannels(1)
+        file.setsampwidth(2)
+        file.setframerate(sample_rate)
+        file.writeframes(np.asarray(samples, dtype='<i2').tobytes())
+
+
+def wav_duration(filepath):
+    """
+    Returns the duration of a WAV file in seconds, from its header.
+    """
+    with wave.open(filepath, 'rb') as file:
+        return file.getnframes() / file.getframerate()
+
+
+def join_wav_files(paths, filepath):
+    """
+    Joins WAV files with the same format into one, sample for sample.
+    """
+    with wave.open(filepath, 'wb') as output:
+        for n, path in enumerate(paths):
+            with wave.open(path, 'rb') as file:
+                if n == 0:
+                    output.setparams(file.getparams())
+                output.writeframes(file.readframes(file.getnframes()))
+
+
+def synthetic_speech(text, sample_rate=LOCAL_TTS_SAMPLE_RATE, words=None):
+    """
+    Generates deterministic stand-in speech for a text, at about the pace of a real voice.
+    The timings of the words are appended to words, when given.
+    """
+    segments = []
+    start = 0
+    for word in text.split():
+        # The pitch of a word only depends on the word
+        pitch = 110 + int.from_bytes(hashlib.md5(word.encode()).digest()[:2], 'little') % 110
+        duration = 0.06 * len(word) + 0.05
+        t = np.arange(int(duration * sample_rate)) / sample_rate
+        envelope = np.minimum(1, np.minimum(t, duration - t) * 40)
+        segments.append(8000 * envelope * np.sin(2 * np.pi * pitch * t))
+        pause = 0.35 if word[-1] in '.!?' else 0.08
+        segments.append(np.zeros(int(pause * sample_rate)))
+        if words is not None:
+            words.append([start / sample_rate, (start + len(t)) / sample_rate, word])
+        start += len(t) + int(pause * sample_rate)
+
+    if not segments:
+        return np.zeros(0, dtype=np.int16)
+    return np.concatenate(segments).astype(np.int16)
+
+
+def make_tts_backend(name, aws_access_key=None, aws_secret_access_key=None, aws_server=None,
+                     max_concurrency=TTS_MAX_CONCURRENCY, word_timings=True):
+    """
+    Makes the TTS backend called name, one of TTS_BACKENDS. Without word_timings, backends that
+    need an extra request for them leave them out.
+    """
+    if name == 'polly':
+        return PollyBackend(get_polly_client(aws_server, aws_access_key, aws_secret_access_key,
+                                             max_concurrency * POLLY_CALLS_PER_REQUEST),
+                            max_concurrency, word_timings)
+    if name == 'edge-tts':
+        return EdgeTTSBackend()
+    if name == 'local':
+        return LocalBackend()
+    raise ValueError(f"Unknown TTS backend: {name}, expected one of {', '.join(TTS_BACKENDS)}")
+
+
+class SpeechSynthesizer:
+    """
+    Sends the requests of a TTS backend concurrently from a background event loop, with
+    AdaptiveConcurrency deciding how many are in flight. Transient failures are retried with
+    exponential backoff; submit() returns a concurrent.futures.Future of the page audio file path
+    and its word timings. With a cache, text that was synthesized before with the same voice is
+    copied from the cache, timings included.
+    """
+
+    def __init__(self, backend, max_concurrency=TTS_MAX_CONCURRENCY, initial_concurrency=TTS_INITIAL_CONCURRENCY,
+                 cache=None):
+        self.backend = backend
+        self.cache = cache
+        self.loop = asyncio.new_event_loop()
+        self.concurrency = AdaptiveConcurrency(min(initial_concurrency, max_concurrency), max_concurrency)
+        # Backend requests sent, retries included
+        self.requests = 0
+        # Short pages held back by submit_page, as (text, audio file, future of the audio file)
+        self._batch = []
+        self._thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self._thread.start()
+
+    def submit(self, text, filepath):
+        return asyncio.run_coroutine_threadsafe(self._synthesize_page(text, filepath), self.loop)
+
+    def submit_page(self, text, filepath, coalesce=True):
+        """
+        Like submit(), but with coalesce, short pages are held back to go out in one request with the
+        short pages after them, when the backend supports it. flush() sends the pages held back.
+        """
+        text = normalize_text(text)
+        if not (coalesce and self.backend.supports_batch and 0 < len(text) <= TTS_COALESCE_PAGE_CHARS):
+            self.flush()
+            return self.submit(text, filepath)
+
+        batch_chars = sum(len(batch_text) + 1 for batch_text, _, _ in self._batch)
+        if len(self._batch) == TTS_COALESCE_MAX_PAGES or batch_chars + len(text) > TTS_CHUNK_CHARS:
+            self.flush()
+        future = Future()
+        self._batch.append((text, filepath, future))
+        return future
+
+    def flush(self):
+        if self._batch:
+            texts, filepaths, futures = map(list, zip(*self._batch))
+            self.submit_batch(texts, filepaths, futures)
+            self._batch.clear()
+
+    async def _synthesize_page(self, text, filepath):
+        """
+        Synthesizes the text of a page. Long text is split at sentence boundaries into chunks that are
+        synthesized concurrently, then joined back into one track.
+        """
+        chunks = split_text(text)
+        if len(chunks) <= 1:
+            return filepath, await self._synthesize(text, filepath)
+
+        chunk_paths = [f"{filepath}.part{n}" for n in range(len(chunks))]
+        chunk_words = await asyncio.gather(*(self._synthesize(chunk, path) for chunk, path in zip(chunks, chunk_paths)))
+
+        # The timings of every chunk move by the duration of the chunks before it
+        words = None
+        if all(timings is not None for timings in chunk_words):
+            words, offset = [], 0
+            for path, timings in zip(chunk_paths, chunk_words):
+                words += [[start + offset, end + offset, word] for start, end, word in timings]
+                offset += wav_duration(path)
+
+        self.backend.join(chunk_paths, filepath)
+        for path in chunk_paths:
+            os.remove(path)
+        return filepath, words
+
+    async def _synthesize(self, text, filepath):
+        key = self.backend.cache_key(text) if self.cache is not None else None
+        hit, words = self._from_cache(key, filepath)
+        if hit:
+            return words
+
+        words = await self._request(lambda: self.backend.synthesize(text, filepath))
+        self._to_cache(key, filepath, words)
+        return words
+
+    def submit_clip(self, text, filepath, image_in, video_out, fade_duration):
+        """
+        Synthesizes the text of a page while its clip is encoded, piping the audio into the encoder as it
+        arrives. Returns a concurrent.futures.Future of the page audio file path, word timings and clip duration.
+        """
+        return asyncio.run_coroutine_threadsafe(
+            self._synthesize_clip(text, filepath, image_in, video_out, fade_duration), self.loop)
+
+    async def _synthesize_clip(self, text, filepath, image_in, video_out, fade_duration):
+        key = self.backend.cache_key(text) if self.cache is not None else None
+        hit, words = self._from_cache(key, filepath)
+        if hit:
+            # Untrimmed like a streamed clip, so the clip is the same whether its audio was cached or not
+            await asyncio.to_thread(encode_clip, image_in, filepath, video_out, fade_duration)
+        else:
+            words = await self._request(lambda: self._stream_clip(text, filepath, image_in, video_out, fade_duration))
+            self._to_cache(key, filepath, words)
+        return filepath, words, wav_duration(filepath) + fade_duration
+
+    async def _stream_clip(self, text, filepath, image_in, video_out, fade_duration):
+        encoder = await asyncio.create_subprocess_shell(
+            clip_encoder_command(image_in, self.backend.stream_input, video_out, filepath, fade_duration),
+            stdin=subprocess.PIPE)
+        words = []
+        try:
+            async for chunk in self.backend.stream(text, words):
+                encoder.stdin.write(chunk)
+                await encoder.stdin.drain()
+            encoder.stdin.close()
+        except BaseException:
+            # A failed request is retried from scratch, with a new encoder
+            encoder.kill()
+            await encoder.wait()
+            raise
+
+        if await encoder.wait():
+            raise TTSError(f"Could not encode {video_out}")
+        return words or None
+
+    def submit_batch(self, texts, filepaths, futures):
+        """
+        Synthesizes the texts of consecutive pages with one backend request, and resolves futures,
+        one concurrent.futures.Future per page, to the page audio file paths and word timings.
+        """
+        asyncio.run_coroutine_threadsafe(self._synthesize_batch(texts, filepaths, futures), self.loop)
+
+    async def _synthesize_batch(self, texts, filepaths, futures):
+        try:
+            keys = [self.backend.cache_key(text) if self.cache is not None else None for text in texts]
+            words = [None] * len(texts)
+            # Only the pages missing from the cache go into the request
+            missing = []
+            for n, (key, filepath) in enumerate(zip(keys, filepaths)):
+                hit, words[n] = self._from_cache(key, filepath)
+                if not hit:
+                    missing.append(n)
+            if missing:
+                timings = await self._request(lambda: self.backend.synthesize_batch([texts[n] for n in missing],
+                                                                                    [filepaths[n] for n in missing]))
+                for n, page_words in zip(missing, timings):
+                    words[n] = page_words
+                    self._to_cache(keys[n], filepaths[n], page_words)
+        except asyncio.CancelledError:
+            for future in futures:
+                future.cancel()
+            raise
+        except Exception as error:
+            for future in futures:
+                future.set_exception(error)
+        else:
+            for future, filepath, page_words in zip(futures, filepaths, words):
+                future.set_result((filepath, page_words))
+
+    async def _request(self, synthesize):
+        """
+        Awaits synthesize(), a backend request, within the concurrency limit, and returns its result.
+        Transient failures are retried with exponential backoff.
+        """
+        for attempt in range(TTS_MAX_ATTEMPTS):
+            async with self.concurrency:
+                self.requests += 1
+                try:
+                    result = await synthesize()
+                except TTSError as error:
+                    if not error.transient or attempt == TTS_MAX_ATTEMPTS - 1:
+                        raise
+                    if error.throttled:
+                        self.concurrency.throttled()
+                    print(f"TTS request failed, retrying: {error}")
+                else:
+                    self.concurrency.succeeded()
+                    return result
+
+            # Full jitter, so the retried requests don't all come back at once
+            await asyncio.sleep(random.uniform(0, min(TTS_MAX_BACKOFF, TTS_BASE_BACKOFF * 2 ** attempt)))
+
+    def _from_cache(self, key, filepath):
+        """
+        Copies the cached audio of key to filepath. Returns whether it was cached, and its word timings.
+        """
+        if key is None:
+            return False, None
+        paths = self.cache.lookup_group(key, (self.backend.audio_ext, '.json'))
+        if not paths:
+            return False, None
+        cached_path, timings_path = paths
+        shutil.copyfile(cached_path, filepath)
+        with open(timings_path) as file:
+            return True, json.load(file)
+
+    def _to_cache(self, key, filepath, words):
+        if key is not None:
+            with open(filepath, 'rb') as audio:
+                self.cache.store(key, self.backend.audio_ext, lambda file: shutil.copyfileobj(audio, file))
+            self.cache.store(key, '.json', lambda file: file.write(json.dumps(words).encode()))
+
+    async def _cancel_requests(self):
+        requests = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+        for request in requests:
+            request.cancel()
+        await asyncio.gather(*requests, return_exceptions=True)
+
+    def close(self):
+        """
+        Cancels the requests still in flight, e.g. when a page failed, and stops the event loop.
+        """
+        asyncio.run_coroutine_threadsafe(self._cancel_requests(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join()
+        self.loop.close()
+
+
+def estimate_word_timings(text, duration):
+    """
+    Spreads the words of a text over duration seconds in proportion to their length,
+    for audio that came without word timings.
+    """
+    words = text.split()
+    total = sum(len(word) + 1 for word in words)
+    timings = []
+    start = 0
+    for word in words:
+        end = start + duration * (len(word) + 1) / total
+        timings.append([start, end, word])
+        start = end
+    return timings
+
+
+def shift_words(words, offset):
+    """
+    Moves word timings offset seconds earlier, as when the audio before them was cut off.
+    """
+    return [[max(0, start - offset), max(0, end - offset), word] for start, end, word in words]
+
+
+def subtitle_cues(words, max_chars=SUBTITLE_MAX_CHARS):
+    """
+    Groups word timings into subtitle cues, (start, end, text), of at most max_chars that end at sentence ends.
+    """
+    cues = []
+    for start, end, word in words:
+        if cues and len(cues[-1][2]) + 1 + len(word) <= max_chars and cues[-1][2][-1] not in '.!?':
+            cues[-1][1] = end
+            cues[-1][2] += ' ' + word
+        else:
+            cues.append([start, end, word])
+    return [tuple(cue) for cue in cues]
+
+
+def timeline_cues(clips, clip_timings, fade_duration):
+    """
+    Places the subtitle cues of consecutive clips on the timeline of the merged video, where every clip
+    starts fade_duration before the end of the one before it. clip_timings maps each clip to its
+    duration and word timings.
+    """
+    cues = []
+    start = 0
+    for clip in clips:
+        duration, words = clip_timings[clip]
+        end = start + duration - fade_duration
+        for cue_start, cue_end, text in subtitle_cues(words):
+            if start + cue_start < end:
+                cues.append((start + cue_start, min(start + cue_end, end), text))
+        start = end
+    return cues
+
+
+def srt_time(seconds):
+    milliseconds = round(seconds * 1000)
+    hours, milliseconds = divmod(milliseconds, 3600 * 1000)
+    minutes, milliseconds = divmod(milliseconds, 60 * 1000)
+    seconds, milliseconds = divmod(milliseconds, 1000)
+    return f"{hours:02}:{minutes:02}:{seconds:02},{milliseconds:03}"
+
+
+def write_srt(cues, filepath):
+    with open(filepath, 'w', encoding='utf-8') as file:
+        for n, (start, end, text) in enumerate(cues, 1):
+            file.write(f"{n}\n{srt_time(start)} --> {srt_time(end)}\n{text}\n\n")
+
+
+def clip_encoder_command(image_in, audio_input, video_out, audio_out, pad_duration):
+    """
+    Returns the ffmpeg command that encodes a frame with the audio piped to its standard input, in the
+    format of the audio_input options, into a clip that ends pad_duration after the audio. The audio is
+    also saved to audio_out as WAV.
+    """
+    return ('ffmpeg.exe -y ' + ffmpeg_frame_input(image_in) + ' ' + audio_input + ' -i pipe:0 -af apad=pad_dur=' +
+            str(pad_duration) + ' -shortest -vcodec libx264 -r ' + str(VIDEO_FPS) + ' -c:a aac -b:a 384k ' +
+            video_out + ' -map 1:a -ac 1 -c:a pcm_s16le ' + audio_out)
+
+
+def encode_clip(image_in, audio_in, video_out, pad_duration):
+    """
+    Encodes a frame and an audio file as it is, silence included, into a clip that ends pad_duration
+    after the audio, like the clips of clip_encoder_command.
+    """
+    encode_clip = 'ffmpeg.exe -y ' + ffmpeg_frame_input(image_in) + ' -i ' + audio_in + ' -af apad=pad_dur=' + str(
+        pad_duration) + ' -shortest -vcodec libx264 -r ' + str(VIDEO_FPS) + ' -c:a aac -b:a 384k ' + video_out
+
+    subprocess.check_output(encode_clip, shell=True)
+
+
+def make_silent_clip(image_in, video_out, duration):
+    """
+    Encodes a frame into a clip of duration seconds with a silent audio track, generated by ffmpeg.
+    """
+    make_silent_clip = 'ffmpeg.exe -y ' + ffmpeg_frame_input(image_in) + \
+        ' -f lavfi -i anullsrc=channel_layout=mono:sample_rate=' + str(AUDIO_SAMPLE_RATE) + ' -t ' + str(
+        duration) + ' -vcodec libx264 -r ' + str(VIDEO_FPS) + ' -c:a aac -b:a 384k ' + video_out
+
+    subprocess.check_output(make_silent_clip, shell=True)
+
+
+def merge_image_audio(image_in, audio_in, video_out, fade_duration):
+    """
+    Encodes a frame and its WAV audio, with the silence trimmed off both ends, into a clip that ends
+    fade_duration after the audio. Returns the duration of the clip, and where the trimmed audio
+    starts in the original, in seconds.
+    """
+    audio_in_2 = audio_in + 'hax.wav'
+
+    duration, offset = trim_wav(audio_in, audio_in_2)
 
     duration += fade_duration
 
-    make_audio_image_clip = 'ffmpeg.exe -y -loop 1  -i ' + image_in + ' -i ' + audio_in + ' -t ' + str(
-        duration) + ' -af apad -vcodec libx264 -r 30  -c:a aac -b:a 384k ' + video_out
+    make_audio_image_clip = 'ffmpeg.exe -y ' + ffmpeg_frame_input(image_in) + ' -i ' + audio_in_2 + ' -t ' + str(
+        duration) + ' -af apad -vcodec libx264 -r ' + str(VIDEO_FPS) + ' -c:a aac -b:a 384k ' + video_out
 
     subprocess.check_output(make_audio_image_clip, shell=True)
+    return duration, offset
 
 
 def extract_audio(video_in, audio_out):
@@ -209,11 +1611,49 @@ def merge_all_clips(list_in, video_out):
     subprocess.check_output(make_audio_image_clip, shell=True)
 
 
-def get_length(filename):
+def probe_media(filename):
+    """
+    Returns the duration and the streams of a media file, in one ffprobe run.
+    """
     result = subprocess.run(
-        ["ffprobe.exe", "-v", "error", "-show_entries", "format=duration", "-of", "default=noprint_wrappers=1:nokey=1",
-         filename], stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-    return float(result.stdout)
+        ["ffprobe.exe", "-v", "error", "-show_entries",
+         "format=duration:stream=index,codec_type,codec_name,profile,pix_fmt,sample_rate,channels",
+         "-of", "json", filename], stdout=subprocess.PIPE, stderr=subprocess.STDOUT, check=True)
+    info = json.loads(result.stdout)
+    return {'duration': float(info['format']['duration']), 'streams': info.get('streams', [])}
+
+
+class MediaRegistry:
+    """
+    Duration and streams of the media files a video is made of. The stage that makes a file records
+    what it knows about it, so the later stages don't have to probe it; files nobody recorded, or
+    whose streams weren't recorded, are probed once, on first use.
+    """
+
+    def __init__(self):
+        self._media = {}
+        self.probes = 0
+
+    def record(self, filename, duration, streams=None):
+        self._media[os.path.normpath(filename)] = {'duration': duration, 'streams': streams}
+
+    def _probe(self, filename):
+        self.probes += 1
+        info = probe_media(filename)
+        self._media[os.path.normpath(filename)] = info
+        return info
+
+    def duration(self, filename):
+        info = self._media.get(os.path.normpath(filename))
+        if info is None:
+            info = self._probe(filename)
+        return info['duration']
+
+    def streams(self, filename):
+        info = self._media.get(os.path.normpath(filename))
+        if info is None or info['streams'] is None:
+            info = self._probe(filename)
+        return info['streams']
 
 
 def add_bg_audio(input_video, background_audio, main_volume, bg_volume, output_video):
@@ -236,7 +1676,14 @@ def add_bg_audio(input_video, background_audio, main_volume, bg_volume, output_v
     subprocess.run(ffmpeg_cmd, shell=True)
 
 
-def ffmpeg_fade_merge(filepaths, fade_duration, video_out):
+def ffmpeg_fade_merge(filepaths, fade_duration, video_out, media=None):
+    """
+    Crossfades the clips into one video. Their durations come from the media registry, which probes
+    each clip at most once.
+    """
+    media = media or MediaRegistry()
+    durations = [media.duration(filepath) for filepath in filepaths]
+
     cmd = 'ffmpeg.exe -y -vsync 0'
     for i, filepath in enumerate(filepaths):
         cmd += ' -i ' + filepath
@@ -247,15 +1694,15 @@ def ffmpeg_fade_merge(filepaths, fade_duration, video_out):
         cmd += f'[{i}]settb=AVTB[{i}:v];'
 
     for i, filepath in enumerate(filepaths):
-        # cmd += f'[{i}]atrim={get_length(filepath)}[{i}:a];'
-        cmd += f'[{i}]atrim=0:{get_length(filepath)}[{i}:a];'
+        # cmd += f'[{i}]atrim={durations[i]}[{i}:a];'
+        cmd += f'[{i}]atrim=0:{durations[i]}[{i}:a];'
     current_total_time = 0
     for i, filepath in enumerate(filepaths):
-        print(get_length(filepath))
+        print(durations[i])
 
         if not i == (len(filepaths) - 1):  # skip last
-            # current_total_time += get_length(filepath)
-            current_total_time += get_length(filepath) - fade_duration
+            # current_total_time += durations[i]
+            current_total_time += durations[i] - fade_duration
             # fade_time = current_total_time - fade_duration
             fade_time = current_total_time
             if i == 0:  # first
@@ -277,7 +1724,7 @@ def ffmpeg_fade_merge(filepaths, fade_duration, video_out):
     #             cmd += f'[a{i}][{i + 1}:a]acrossfade=d={fade_duration}:c1=tri:c2=tri[a{i + 1}];'
 
     for i, filepath in enumerate(filepaths):
-        audio_trim_time = get_length(filepath) - fade_duration
+        audio_trim_time = durations[i] - fade_duration
         cmd += f'[{i}:a]atrim=0:{audio_trim_time}[{i}a];'
     for i, filepath in enumerate(filepaths):
         cmd += f'[{i}a]'
@@ -292,37 +1739,259 @@ def ffmpeg_fade_merge(filepaths, fade_duration, video_out):
         print(line)  # return '\n'.join(script_lines)
 
 
-def convert_to_mp4(video_in, video_out):
-    convert_to_mp4 = 'ffmpeg.exe -y -i "' + video_in + '" -c:v libx264 -c:a aac "' + video_out + '"'
-    subprocess.check_output(convert_to_mp4, shell=True)
+def final_codec_args(streams):
+    """
+    Returns the ffmpeg codec arguments that bring the video streams to H.264 yuv420p and the audio streams
+    to AAC, copying the kinds of streams that already are.
+    """
+    video = [stream for stream in streams if stream.get('codec_type') == 'video']
+    audio = [stream for stream in streams if stream.get('codec_type') == 'audio']
+    args = []
+    if all(stream.get('codec_name') == 'h264' and stream.get('pix_fmt') == 'yuv420p' for stream in video):
+        args += ['-c:v', 'copy']
+    else:
+        args += ['-c:v', 'libx264', '-pix_fmt', 'yuv420p']
+    if all(stream.get('codec_name') == 'aac' for stream in audio):
+        args += ['-c:a', 'copy']
+    else:
+        args += ['-c:a', 'aac']
+    return args
 
 
-def make_clips(data, mp3_file, blur, brightness, fade_duration, main_volume, bg_volume, polly, final_video):
-    clips_to_merge = []
+def finalize_video(video_in, video_out, media=None, subtitles_in=None):
+    """
+    Makes the final MP4 of a video: only the streams that aren't H.264 yuv420p or AAC yet are transcoded,
+    see final_codec_args, so a compliant video is just remuxed, with the index at the start for playback
+    while downloading. With subtitles_in, the SRT file is muxed in as well, as a soft mov_text subtitle stream.
+    """
+    media = media or MediaRegistry()
+    codec_args = final_codec_args(media.streams(video_in))
+
+    cmd = ['ffmpeg.exe', '-y', '-i', video_in]
+    maps = ['-map', '0:v', '-map', '0:a?']
+    if subtitles_in is not None:
+        cmd += ['-i', subtitles_in]
+        maps += ['-map', '1:s', '-c:s', 'mov_text', '-metadata:s:s:0', 'language=' + SUBTITLE_LANGUAGE]
+    cmd += maps + codec_args + ['-movflags', '+faststart', video_out]
+
+    print(' '.join(cmd))
+    subprocess.check_output(cmd)
+
+
+def plan_render(segments, fade_duration, main_volume, bg_volume):
+    """
+    Plans the whole video as a single ffmpeg run. segments are (frame path, audio path or None for
+    silence, duration) per page, in order; every page crossfades into the next over fade_duration.
+    Returns the input arguments of the pages, the filtergraph, and the input index of the background
+    audio, which goes after the pages: the graph mixes it under the narration into [audio], next to [video].
+    """
+    inputs = []
+    graph = []
     count = 0
-    for i in range(len(data)):
+    for i, (frame, audio, duration) in enumerate(segments):
+        # A still, looped for as long as the page is on screen
+        inputs += ['-t', str(duration)] + ffmpeg_frame_args(frame)
+        graph.append(f'[{count}:v]fps={VIDEO_FPS},format=yuv420p,settb=AVTB[v{i}]')
         count += 1
+        # Its audio, padded with silence and cut where the next page starts
+        if audio is None:
+            source = f'anullsrc=channel_layout=mono:sample_rate={AUDIO_SAMPLE_RATE}'
+        else:
+            inputs += ['-i', audio]
+            source = f'[{count}:a]aformat=sample_rates={AUDIO_SAMPLE_RATE}:channel_layouts=mono,apad'
+            count += 1
+        graph.append(f'{source},atrim=0:{duration - fade_duration}[a{i}]')
+
+    # The crossfades start where the pages before them end, minus the fades they overlap
+    offset = 0
+    video = 'v0'
+    for i in range(1, len(segments)):
+        offset += segments[i - 1][2] - fade_duration
+        graph.append(f'[{video}][v{i}]xfade=transition=fade:duration={fade_duration}:offset={offset}[x{i}]')
+        video = f'x{i}'
+    graph.append(f'[{video}]format=yuv420p[video]')
+
+    bg_input = count
+    graph.append(''.join(f'[a{i}]' for i in range(len(segments))) + f'concat=n={len(segments)}:v=0:a=1,'
+                 f'volume={main_volume}[speech]')
+    graph.append(f'[{bg_input}:a]volume={bg_volume}[bg]')
+    graph.append('[speech][bg]amix=inputs=2:duration=first:dropout_transition=0[audio]')
+    return inputs, ';\n'.join(graph), bg_input
+
+
+def render_video(segments, mp3_file, fade_duration, main_volume, bg_volume, video_out, subtitles_in=None):
+    """
+    Renders the pages, their audio, the crossfades, the background audio and the subtitles into the final
+    video with one ffmpeg run, so the video and the audio are each encoded exactly once, see plan_render.
+    The filtergraph goes to a script file, and the arguments go to ffmpeg without a shell, so the command
+    stays within the command line limits however many pages there are.
+    """
+    inputs, graph, bg_input = plan_render(segments, fade_duration, main_volume, bg_volume)
+    graph_script = AUX_FOLDER + 'render_graph.txt'
+    with open(graph_script, 'w') as file:
+        file.write(graph)
 
-        input_image_path = f"{AUX_FOLDER}page{count}.png"
-        output_image_path = f"{AUX_FOLDER}page{count}_processed.png"
-        audio_name = AUX_FOLDER + 'output_' + str(i) + '.wav'
+    cmd = ['ffmpeg.exe', '-y'] + inputs + ['-i', mp3_file]
+    outputs = ['-map', '[video]', '-map', '[audio]']
+    if subtitles_in is not None:
+        cmd += ['-i', subtitles_in]
+        outputs += ['-map', f'{bg_input + 1}:s', '-c:s', 'mov_text', '-metadata:s:s:0', 'language=' + SUBTITLE_LANGUAGE]
+    cmd += ['-filter_complex_script', graph_script] + outputs
+    cmd += ['-c:v', 'libx264', '-r', str(VIDEO_FPS), '-c:a', 'aac', '-b:a', '384k', '-movflags', '+faststart', video_out]
 
-        video_name = 'video_' + str(i) + '.mp4'
-        video_out_mp4 = AUX_FOLDER + video_name
+    print(' '.join(cmd))
+    subprocess.run(cmd, check=True)
 
-        process_image(input_image_path, output_image_path, blur, brightness)
-        make_audio_polly(data[i], audio_name, polly)
-        merge_image_audio(output_image_path, audio_name, video_out_mp4, (fade_duration + 0.5))
 
-        clips_to_merge.append(video_out_mp4)
+def page_fingerprint(frame, text):
+    """
+    Fingerprints a page by its rendered frame and its normalized text.
+    Pages with equal fingerprints look and sound the same, so they can share one clip.
+    """
+    digest = hashlib.sha256()
+    digest.update(repr((frame.mode, frame.size)).encode())
+    digest.update(frame.tobytes())
+    digest.update(normalize_text(text).encode())
+    return digest.hexdigest()
+
+
+def make_clips(pages, mp3_file, blur, brightness, fade_duration, main_volume, bg_volume, tts_backend, final_video,
+               frame_cache=None, frame_format='png', tts_concurrency=TTS_MAX_CONCURRENCY, audio_cache=None,
+               coalesce=True, subtitles=True, stream_audio=False, silent_page_duration=SILENT_PAGE_DURATION,
+               single_pass=True):
+    """
+    Makes one clip per (page_index, text, frame) as the pages arrive, then merges them into the final video.
+    With single_pass, the clips are only planned as the pages arrive: their frames and trimmed audio are
+    rendered into the final video by a single ffmpeg run, see render_video, instead of being encoded
+    one by one and re-encoded by every later stage. Streamed audio needs the encoders of its clips.
+    The TTS requests of all pages run concurrently, up to tts_concurrency at a time. With coalesce, runs of
+    consecutive short pages share one request when the backend supports it. With subtitles, the word timings
+    of the speech become an SRT file next to the video, also muxed into it as a soft subtitle stream.
+    With stream_audio, the audio of the other pages is piped into their encoder while it is synthesized,
+    and the clips keep the silence at the ends of their audio, which can't be trimmed. Pages without text
+    make no TTS request, and are shown for silent_page_duration with silence.
+    """
+    clips_to_merge = []
+    compositor = FrameCompositor()
+    # Clips of the pages made so far, by page fingerprint, so repeated slides are only made once
+    clips_by_fingerprint = {}
+    reused_clips = 0
+    silent_pages = 0
+    # Pages waiting for their audio, in page order
+    pending = deque()
+    # Duration and word timings of every clip made
+    clip_timings = {}
+    media = MediaRegistry()
+    synthesizer = SpeechSynthesizer(tts_backend, tts_concurrency, cache=audio_cache)
+    coalesce = coalesce and tts_backend.supports_batch
+    stream_audio = stream_audio and tts_backend.stream_input is not None
+    single_pass = single_pass and not stream_audio
+    # Frame, trimmed audio and duration of every clip, by clip name, when it is rendered in a single pass
+    segments = {}
+
+    def encode(audio, text, output_image_path, video_out_mp4, streamed):
+        if streamed:
+            # Encoded while the audio came in
+            audio_path, words, duration = audio.result()
+        elif single_pass:
+            audio_path, words = audio.result()
+            trimmed_audio_path = audio_path + 'hax.wav'
+            duration, offset = trim_wav(audio_path, trimmed_audio_path)
+            duration += fade_duration + 0.5
+            words = words and shift_words(words, offset)
+            segments[video_out_mp4] = (output_image_path, trimmed_audio_path, duration)
+        else:
+            audio_path, words = audio.result()
+            duration, offset = merge_image_audio(output_image_path, audio_path, video_out_mp4, (fade_duration + 0.5))
+            words = words and shift_words(words, offset)
+        if words is None:
+            words = estimate_word_timings(text, duration - fade_duration - 0.5)
+        clip_timings[video_out_mp4] = (duration, words)
+        if not single_pass:
+            media.record(video_out_mp4, duration)
+
+    try:
+        for i, text, frame in pages:
+            fingerprint = page_fingerprint(frame, text)
+            if fingerprint in clips_by_fingerprint:
+                clips_to_merge.append(clips_by_fingerprint[fingerprint])
+                reused_clips += 1
+                print(f"Page {i + 1} is a duplicate, reusing {clips_by_fingerprint[fingerprint]}")
+                continue
+
+            output_image_path = frame_path(i, frame_format)
+            audio_name = AUX_FOLDER + 'output_' + str(i) + '.wav'
+
+            video_name = 'video_' + str(i) + '.mp4'
+            video_out_mp4 = AUX_FOLDER + video_name
+
+            clips_to_merge.append(video_out_mp4)
+            clips_by_fingerprint[fingerprint] = video_out_mp4
+
+            text = normalize_text(text)
+            if not text:
+                process_image(frame, output_image_path, blur, brightness, compositor, frame_cache)
+                duration = silent_page_duration + fade_duration + 0.5
+                if single_pass:
+                    segments[video_out_mp4] = (output_image_path, None, duration)
+                else:
+                    make_silent_clip(output_image_path, video_out_mp4, duration)
+                    media.record(video_out_mp4, duration)
+                clip_timings[video_out_mp4] = (duration, [])
+                silent_pages += 1
+                continue
+
+            # The request goes out now, and the page is encoded once its audio is back
+            streamed = False
+            # Short pages coalesced into one request can't be streamed to their own encoders
+            batched = coalesce and 0 < len(text) <= TTS_COALESCE_PAGE_CHARS
+            if stream_audio and not batched and 0 < len(text) <= TTS_CHUNK_CHARS:
+                synthesizer.flush()
+                # The encoder starts with the request, so the frame has to be ready first
+                process_image(frame, output_image_path, blur, brightness, compositor, frame_cache)
+                audio = synthesizer.submit_clip(text, audio_name, output_image_path, video_out_mp4,
+                                                (fade_duration + 0.5))
+                streamed = True
+            else:
+                audio = synthesizer.submit_page(text, audio_name, coalesce)
+            if not streamed:
+                process_image(frame, output_image_path, blur, brightness, compositor, frame_cache)
+            pending.append((audio, text, output_image_path, video_out_mp4, streamed))
+
+            # Encode the pages whose audio is already back, while the later requests are in flight
+            while pending and pending[0][0].done():
+                encode(*pending.popleft())
+
+        synthesizer.flush()
+        while pending:
+            encode(*pending.popleft())
+    finally:
+        synthesizer.close()
+
+    print(f"Pages: {len(clips_to_merge)}, duplicate pages reusing a clip: {reused_clips}, "
+          f"pages without text: {silent_pages}, TTS requests: {synthesizer.requests}, "
+          f"service calls: {tts_backend.calls}")
+    if frame_cache is not None:
+        print(f"Frame cache: {frame_cache.hits} hits, {frame_cache.misses} misses")
+    if audio_cache is not None:
+        print(f"Audio cache: {audio_cache.hits} hits, {audio_cache.misses} misses")
+
+    subtitles_srt = os.path.splitext(final_video)[0] + '.srt' if subtitles else None
+    if subtitles:
+        write_srt(timeline_cues(clips_to_merge, clip_timings, fade_duration), subtitles_srt)
+
+    if single_pass:
+        render_video([segments[clip] for clip in clips_to_merge], mp3_file, fade_duration, main_volume, bg_volume,
+                     final_video, subtitles_srt)
+        return
 
     video_merged = AUX_FOLDER + 'video_ALL_MERGED.mp4'
-    ffmpeg_fade_merge(clips_to_merge, fade_duration, video_merged)
+    ffmpeg_fade_merge(clips_to_merge, fade_duration, video_merged, media)
 
     video_merged_bg_audio = AUX_FOLDER + 'video_ALL_MERGED_with_bg_audio.mp4'
     add_bg_audio(video_merged, mp3_file, main_volume, bg_volume, video_merged_bg_audio)
 
-    convert_to_mp4(video_merged_bg_audio, final_video)
+    finalize_video(video_merged_bg_audio, final_video, media, subtitles_srt)
 
 
 def make_video_final_name(pdf_file):
@@ -332,27 +2001,153 @@ def make_video_final_name(pdf_file):
     return VIDEOS_FOLDER + str_3 + '.mp4'
 
 
-def instantiate_polly(aws_access_key, aws_secret_access_key, aws_server):
-    # Create a client using the credentials and region defined in the [adminuser]
-    # section of the AWS credentials file (~/.aws/credentials).
+def get_polly_client(aws_server, aws_access_key=None, aws_secret_access_key=None,
+                     max_concurrency=TTS_MAX_CONCURRENCY, max_attempts=1):
+    """
+    Returns the Polly client of a region and credentials, shared by every page, document and backend of
+    the process, so clients are built and TLS connections set up once. Its pool keeps max_concurrency
+    connections alive between requests; a client with a smaller pool is replaced by a bigger one.
+    The default of a single attempt leaves retries to SpeechSynthesizer, which needs to see the
+    throttling errors to adapt its concurrency.
+    """
+    key = (aws_server, aws_access_key, aws_secret_access_key, max_attempts)
+    with _polly_clients_lock:
+        client = _polly_clients.get(key)
+        if client is None or client.meta.config.max_pool_connections < max_concurrency:
+            # Without credentials, boto3 falls back to the environment and ~/.aws/credentials
+            config = Config(retries={'mode': 'standard', 'max_attempts': max_attempts},
+                            max_pool_connections=max_concurrency, tcp_keepalive=True)
+            client = boto3.client('polly', region_name=aws_server, aws_access_key_id=aws_access_key,
+                                  aws_secret_access_key=aws_secret_access_key, config=config)
+            _polly_clients[key] = client
+        return client
+
 
-    return boto3.client('polly', region_name=aws_server, aws_access_key_id=aws_access_key,
-                        aws_secret_access_key=aws_secret_access_key)
+def instantiate_polly(aws_access_key, aws_secret_access_key, aws_server, max_concurrency=TTS_MAX_CONCURRENCY):
+    return get_polly_client(aws_server, aws_access_key, aws_secret_access_key, max_concurrency)
 
 
 def make_pdf_video(pdf_file, mp3_file, blur, brightness, fade_duration, main_volume, bg_volume, aws_access_key,
-                   aws_secret_access_key, aws_server):
+                   aws_secret_access_key, aws_server, workers=EXTRACT_WORKERS, debug=False, use_cache=True,
+                   frame_format='png', strip_running_text=True, tts_concurrency=TTS_MAX_CONCURRENCY,
+                   tts_backend='polly', coalesce=True, subtitles=True, stream_audio=False,
+                   silent_page_duration=SILENT_PAGE_DURATION, single_pass=True):
     if not os.path.exists(AUX_FOLDER):
         os.makedirs(AUX_FOLDER)
 
     if not os.path.exists(VIDEOS_FOLDER):
         os.makedirs(VIDEOS_FOLDER)
 
+    frame_cache = DiskCache(FRAME_CACHE_FOLDER, FRAME_CACHE_MAX_BYTES) if use_cache else None
+    audio_cache = DiskCache(AUDIO_CACHE_FOLDER, AUDIO_CACHE_MAX_BYTES) if use_cache else None
+
     print(pdf_file)
-    data = extract_text_and_images(pdf_file)
+    # A quick text-only pass, so the narration leaves out running headers and footers
+    running_text = find_running_text(pdf_file) if strip_running_text else None
+    # Pages are rendered lazily, so clip work starts as soon as the first page is ready
+    pages = iter_pages(pdf_file, workers, save_pages=debug, cache=frame_cache, running_text=running_text)
     final_video = make_video_final_name(pdf_file)
-    polly = instantiate_polly(aws_access_key, aws_secret_access_key, aws_server)
+    backend = make_tts_backend(tts_backend, aws_access_key, aws_secret_access_key, aws_server, tts_concurrency,
+                               word_timings=subtitles)
     print(mp3_file)
 
-    make_clips(data, mp3_file, blur, brightness, fade_duration, main_volume, bg_volume, polly, final_video)
+    try:
+        make_clips(pages, mp3_file, blur, brightness, fade_duration, main_volume, bg_volume, backend, final_video,
+                   frame_cache=frame_cache, frame_format=frame_format, tts_concurrency=tts_concurrency,
+                   audio_cache=audio_cache, coalesce=coalesce, subtitles=subtitles, stream_audio=stream_audio,
+                   silent_page_duration=silent_page_duration, single_pass=single_pass)
+    finally:
+        backend.close()
 
+
+def prefetch_pdf(pdf_file, aws_access_key=None, aws_secret_access_key=None, aws_server=None, tts_backend='polly',
+                 cancel=None, workers=EXTRACT_WORKERS, strip_running_text=True, tts_concurrency=TTS_MAX_CONCURRENCY,
+                 coalesce=True, subtitles=True):
+    """
+    Runs ahead the stages of make_pdf_video that don't depend on the visual and audio settings: rendering
+    the pages and synthesizing their speech. The results only go into the caches, where make_pdf_video of
+    the same PDF, backend and options picks them up. Stops as soon as the cancel threading.Event is set.
+    """
+    os.makedirs(AUX_FOLDER, exist_ok=True)
+    # The audio files themselves are thrown away, in a folder of their own in case another prefetch overlaps
+    prefetch_folder = tempfile.mkdtemp(prefix='prefetch_', dir=AUX_FOLDER)
+
+    frame_cache = DiskCache(FRAME_CACHE_FOLDER, FRAME_CACHE_MAX_BYTES)
+    audio_cache = DiskCache(AUDIO_CACHE_FOLDER, AUDIO_CACHE_MAX_BYTES)
+
+    running_text = find_running_text(pdf_file) if strip_running_text else None
+    pages = iter_pages(pdf_file, workers, cache=frame_cache, running_text=running_text)
+    backend = make_tts_backend(tts_backend, aws_access_key, aws_secret_access_key, aws_server, tts_concurrency,
+                               word_timings=subtitles)
+    synthesizer = SpeechSynthesizer(backend, tts_concurrency, cache=audio_cache)
+    requests = []
+    texts = set()
+    try:
+        for i, text, _ in pages:
+            if cancel is not None and cancel.is_set():
+                break
+            text = normalize_text(text)
+            if text and text not in texts:
+                texts.add(text)
+                requests.append(synthesizer.submit_page(text, os.path.join(prefetch_folder, f'output_{i}.wav'),
+                                                        coalesce))
+        synthesizer.flush()
+
+        while requests and not (cancel is not None and cancel.is_set()):
+            _, not_done = wait(requests, timeout=0.1)
+            requests = list(not_done)
+    finally:
+        pages.close()
+        synthesizer.close()
+        backend.close()
+        shutil.rmtree(prefetch_folder, ignore_errors=True)
+
+    print(f"Prefetched {pdf_file}: {len(texts)} page texts, {synthesizer.requests} TTS requests, "
+          f"{backend.calls} service calls")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Render a PDF as a 9:16 narrated video.")
+    parser.add_argument('pdf_file', help="PDF to render")
+    parser.add_argument('mp3_file', help="background audio track")
+    parser.add_argument('--blur', type=int, default=8, help="background blur radius (0-100)")
+    parser.add_argument('--brightness', type=float, default=0.5, help="background brightness (0-1)")
+    parser.add_argument('--fade-duration', type=float, default=0.5, help="fade between pages, in seconds")
+    parser.add_argument('--main-volume', type=float, default=1.7, help="narration volume (0-2)")
+    parser.add_argument('--bg-volume', type=float, default=0.04, help="background audio volume (0-2)")
+    parser.add_argument('--silent-page-duration', type=float, default=SILENT_PAGE_DURATION,
+                        help="how long pages without text are shown, in seconds")
+    parser.add_argument('--tts-backend', choices=TTS_BACKENDS, default='polly', help="speech synthesis backend")
+    parser.add_argument('--tts-concurrency', type=int, default=TTS_MAX_CONCURRENCY,
+                        help="maximum concurrent TTS requests")
+    parser.add_argument('--no-coalesce', action='store_true',
+                        help="send one TTS request per page, even for runs of short pages")
+    parser.add_argument('--stream-audio', action='store_true',
+                        help="pipe the speech into the page encoder while it is synthesized")
+    parser.add_argument('--no-subtitles', action='store_true', help="do not make subtitles from the speech")
+    parser.add_argument('--per-clip-encode', action='store_true',
+                        help="encode a clip per page and merge them, instead of rendering in a single pass")
+    parser.add_argument('--aws-access-key', default=os.environ.get('AWS_ACCESS_KEY_ID'))
+    parser.add_argument('--aws-secret-access-key', default=os.environ.get('AWS_SECRET_ACCESS_KEY'))
+    parser.add_argument('--aws-server', default=os.environ.get('AWS_DEFAULT_REGION', 'eu-central-1'))
+    parser.add_argument('--workers', type=int, default=EXTRACT_WORKERS, help="processes rendering pages")
+    parser.add_argument('--frame-format', choices=FRAME_FORMATS, default='png',
+                        help="format of the intermediate frames")
+    parser.add_argument('--keep-running-text', action='store_true',
+                        help="narrate running headers, footers and page numbers too")
+    parser.add_argument('--no-cache', action='store_true', help="do not use the frame and audio caches")
+    parser.add_argument('--debug', action='store_true', help="save the rendered pages as PNG")
+    args = parser.parse_args()
+
+    make_pdf_video(args.pdf_file, args.mp3_file, args.blur, args.brightness, args.fade_duration, args.main_volume,
+                   args.bg_volume, args.aws_access_key, args.aws_secret_access_key, args.aws_server,
+                   workers=args.workers, debug=args.debug, use_cache=not args.no_cache,
+                   frame_format=args.frame_format, strip_running_text=not args.keep_running_text,
+                   tts_concurrency=args.tts_concurrency, tts_backend=args.tts_backend,
+                   coalesce=not args.no_coalesce, subtitles=not args.no_subtitles,
+                   stream_audio=args.stream_audio, silent_page_duration=args.silent_page_duration,
+                   single_pass=not args.per_clip_encode)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+import json
+import re
+
+import numpy as np
+import pytest
+
+import make_video_pdf_engine as engine
+
+RATE = 16000
+
+
+def tone(seconds, amplitude=8000):
+    return (np.sin(np.arange(int(seconds * RATE)) * 0.2) * amplitude).astype(np.int16)
+
+
+def silence(seconds):
+    return np.zeros(int(seconds * RATE), dtype=np.int16)
+
+
+def test_silence_bounds_keeps_silence_around_the_speech():
+    samples = np.concatenate([silence(1), tone(0.5), silence(1)])
+    loud = np.flatnonzero(np.abs(samples.astype(int)) > 32768 * 10 ** (engine.SILENCE_THRESHOLD_DB / 20))
+    margin = round(engine.SILENCE_KEEP * RATE)
+
+    assert engine.silence_bounds(samples, RATE) == (loud[0] - margin, loud[-1] + 1 + margin)
+
+
+def test_silence_bounds_ignores_noise_under_the_threshold():
+    quiet = int(32768 * 10 ** (engine.SILENCE_THRESHOLD_DB / 20)) - 1
+    samples = np.concatenate([np.full(RATE, quiet, dtype=np.int16), tone(0.5), np.full(RATE, -quiet, dtype=np.int16)])
+    start, stop = engine.silence_bounds(samples, RATE)
+
+    assert start == pytest.approx(RATE - engine.SILENCE_KEEP * RATE, abs=1)
+    assert stop == pytest.approx(1.5 * RATE + engine.SILENCE_KEEP * RATE, abs=1)
+
+
+def test_silence_bounds_stay_within_the_samples():
+    samples = tone(1)
+    assert engine.silence_bounds(samples, RATE) == (0, len(samples))
+
+
+def test_silence_bounds_of_silence_are_empty():
+    assert engine.silence_bounds(silence(1), RATE) == (0, 0)
+
+
+def test_trim_wav_returns_the_duration_and_the_offset(tmp_path):
+    in_path, out_path = str(tmp_path / 'in.wav'), str(tmp_path / 'out.wav')
+    engine.write_wav(in_path, np.concatenate([silence(1), tone(0.5), silence(1)]), RATE)
+
+    duration, offset = engine.trim_wav(in_path, out_path)
+
+    assert offset == pytest.approx(1 - engine.SILENCE_KEEP, abs=1 / RATE)
+    assert duration == pytest.approx(0.5 + 2 * engine.SILENCE_KEEP, abs=2 / RATE)
+    assert engine.wav_duration(out_path) == pytest.approx(duration)
+
+
+def speech_marks(*marks):
+    return '\n'.join(json.dumps({'time': time, 'type': kind, 'value': value}) for time, kind, value in marks).encode()
+
+
+def test_split_pcm_at_marks_cuts_at_the_ssml_marks():
+    pcm = np.arange(3 * RATE, dtype=np.int16).tobytes()
+    marks = speech_marks((100, 'ssml', '0'), (150, 'word', 'one'), (600, 'word', 'two'),
+                         (1100, 'ssml', '1'), (1200, 'word', 'three'))
+
+    (first, first_words), (second, second_words) = engine.split_pcm_at_marks(pcm, marks, 2, RATE)
+
+    assert first[0] == round(0.1 * RATE) and len(first) == RATE
+    assert second[0] == round(1.1 * RATE) and len(second) == 3 * RATE - round(1.1 * RATE)
+    assert first_words == [[pytest.approx(0.05), pytest.approx(0.5), 'one'],
+                           [pytest.approx(0.5), pytest.approx(1.0), 'two']]
+    assert second_words == [[pytest.approx(0.1), pytest.approx(1.9), 'three']]
+
+
+def test_split_pcm_at_marks_needs_a_mark_per_text():
+    pcm = np.zeros(RATE, dtype=np.int16).tobytes()
+    with pytest.raises(engine.TTSError):
+        engine.split_pcm_at_marks(pcm, speech_marks((0, 'ssml', '0')), 2, RATE)
+
+
+def graph_filters(graph):
+    return graph.split(';\n')
+
+
+def test_plan_render_chains_the_crossfades_and_trims_the_page_audio():
+    segments = [('a.png', 'a.wav', 4.0), ('b.png', None, 3.5), ('c.png', 'c.wav', 5.0)]
+
+    inputs, graph, bg_input = engine.plan_render(segments, 0.5, 1.7, 0.04)
+
+    assert [inputs[n + 1] for n, arg in enumerate(inputs) if arg == '-i'] == ['a.png', 'a.wav', 'b.png', 'c.png',
+                                                                             'c.wav']
+    assert bg_input == 5
+    filters = graph_filters(graph)
+    offsets = [float(offset) for offset in re.findall(r'xfade=transition=fade:duration=0\.5:offset=([\d.]+)', graph)]
+    assert offsets == pytest.approx([3.5, 6.5])
+    trims = [float(trim) for trim in re.findall(r'atrim=0:([\d.]+)\[a\d\]', graph)]
+    assert trims == pytest.approx([3.5, 3.0, 4.5])
+    assert filters[3].startswith('anullsrc=')
+    assert '[x2]format=yuv420p[video]' in filters
+    assert '[a0][a1][a2]concat=n=3:v=0:a=1,volume=1.7[speech]' in filters
+    assert '[5:a]volume=0.04[bg]' in filters
+
+
+def test_plan_render_of_a_single_page_has_no_crossfade():
+    inputs, graph, bg_input = engine.plan_render([('a.png', 'a.wav', 4.0)], 0.5, 1.7, 0.04)
+
+    assert bg_input == 2
+    assert 'xfade' not in graph
+    assert '[v0]format=yuv420p[video]' in graph_filters(graph)
@@ -1,4 +1,5 @@
 import json
+import threading
 from tkinter import filedialog
 
 import customtkinter as ctk
@@ -16,7 +17,7 @@ class CustomTkinterApp:
 
         self.master = master
         self.master.title("PDF Video Maker")
-        self.master.geometry("700x550")
+        self.master.geometry("1050x650")
 
         self.pdf_file = ""
         self.mp3_file = ""
@@ -38,6 +39,18 @@ class CustomTkinterApp:
 
         self.selected_aws_server = ctk.StringVar(value=self.aws_server_options[0])
 
+        self.tts_backend_options = list(make_video_pdf_engine.TTS_BACKENDS)
+        self.selected_tts_backend = ctk.StringVar(value=self.tts_backend_options[0])
+
+        self.preview = None
+        self.preview_page_val = ctk.StringVar(value="1")
+        self.preview_job = None
+
+        # Background extraction and speech synthesis of the selected PDF, see start_prefetch
+        self.prefetch_thread = None
+        self.prefetch_cancel = None
+        self.prefetch_settings = None
+
         # Load saved values or set defaults
         try:
             self.load_saved_values()
@@ -62,6 +75,7 @@ class CustomTkinterApp:
         ctk.CTkLabel(self.master, text="AWS Access Key ID:").grid(row=7, column=0, sticky="w", pady=10, padx=10)
         ctk.CTkLabel(self.master, text="AWS Secret access key:").grid(row=8, column=0, sticky="w", pady=10, padx=10)
         ctk.CTkLabel(self.master, text="AWS Server:").grid(row=9, column=0, sticky="w", pady=10, padx=10)
+        ctk.CTkLabel(self.master, text="TTS Backend:").grid(row=10, column=0, sticky="w", pady=10, padx=10)
 
         # File Selectors
         self.pdf_button = ctk.CTkButton(self.master, text="Select PDF", command=self.select_pdf)
@@ -96,13 +110,16 @@ class CustomTkinterApp:
                                                                                                                 pady=10,
                                                                                                                 padx=10))
 
+        ctk.CTkOptionMenu(self.master, values=self.tts_backend_options, variable=self.selected_tts_backend,
+                          command=lambda _: self.start_prefetch()).grid(row=10, column=1, sticky="we", pady=10, padx=10)
+
         # Generate Video Button
         default_button = ctk.CTkButton(self.master, text="Reset Values", command=self.load_default_values)
-        default_button.grid(row=10, column=0, pady=10, padx=10)
+        default_button.grid(row=11, column=0, pady=10, padx=10)
 
         # Generate Video Button
         generate_button = ctk.CTkButton(self.master, text="Generate Video", command=self.generate_video)
-        generate_button.grid(row=10, column=1, pady=10, padx=10)
+        generate_button.grid(row=11, column=1, pady=10, padx=10)
 
         # Labels to display selected values
         self.pdf_label = ctk.CTkLabel(self.master, text="")
@@ -126,6 +143,15 @@ class CustomTkinterApp:
         self.bg_audio_volume_label = ctk.CTkLabel(self.master, text="{:.2f}".format(self.bg_audio_volume_val.get()))
         self.bg_audio_volume_label.grid(row=6, column=2, sticky="w", pady=10, padx=10)
 
+        # Preview of the processed page
+        self.preview_label = ctk.CTkLabel(self.master, text="No PDF selected")
+        self.preview_label.grid(row=0, column=3, rowspan=11, pady=10, padx=10)
+        self.preview_page_menu = ctk.CTkOptionMenu(self.master, values=["1"], variable=self.preview_page_val,
+                                                   command=self.select_preview_page)
+        self.preview_page_menu.grid(row=11, column=3, pady=10, padx=10)
+
+        self.load_preview()
+
     def load_saved_values(self):
         try:
             with open("config.json", "r") as f:
@@ -140,6 +166,7 @@ class CustomTkinterApp:
                 self.aws_access_key_val.set(data.get("aws_access_key_val", ""))
                 self.aws_secret_access_key_val.set(data.get("aws_secret_access_key_val", ""))
                 self.selected_aws_server.set(data.get("selected_aws_server", self.aws_server_options[0]))
+                self.selected_tts_backend.set(data.get("selected_tts_backend", self.tts_backend_options[0]))
         except FileNotFoundError:
             pass
 
@@ -157,6 +184,7 @@ class CustomTkinterApp:
                 self.fade_duration_lable.configure(text="{:.2f}".format(self.fade_duration_val.get()))
                 self.main_audio_volume_label.configure(text="{:.2f}".format(self.main_audio_volume_val.get()))
                 self.bg_audio_volume_label.configure(text="{:.2f}".format(self.bg_audio_volume_val.get()))
+                self.update_preview()
         except FileNotFoundError:
             pass
 
@@ -167,15 +195,55 @@ class CustomTkinterApp:
                 "bg_audio_volume_val": self.bg_audio_volume_val.get(),
                 "aws_access_key_val": self.aws_access_key_val.get(),
                 "aws_secret_access_key_val": self.aws_secret_access_key_val.get(),
-                "selected_aws_server": self.selected_aws_server.get()}
+                "selected_aws_server": self.selected_aws_server.get(),
+                "selected_tts_backend": self.selected_tts_backend.get()}
         with open("config.json", "w") as f:
             json.dump(data, f)
 
     def update_blur_label(self, event):
         self.blur_label.configure(text=str(self.blur_val.get()))
+        self.schedule_preview()
 
     def update_brightness_label(self, event):
         self.brightness_label.configure(text="{:.2f}".format(self.brightness_val.get()))
+        self.schedule_preview()
+
+    def load_preview(self, page_index=0):
+        # Renders the page once at preview size; the sliders then only redo the cheap steps
+        self.preview = None
+        if not self.pdf_file:
+            self.preview_label.configure(image=None, text="No PDF selected")
+            return
+
+        try:
+            self.preview = make_video_pdf_engine.PagePreview(self.pdf_file, page_index)
+        except Exception as error:
+            print(error)
+            self.preview_label.configure(image=None, text="Could not preview the PDF")
+            return
+
+        pages = [str(page + 1) for page in range(self.preview.page_count)]
+        self.preview_page_menu.configure(values=pages)
+        self.preview_page_val.set(str(page_index + 1))
+        self.update_preview()
+
+    def select_preview_page(self, page):
+        self.load_preview(int(page) - 1)
+
+    def schedule_preview(self):
+        # Slider events come faster than previews are needed, only render the latest one
+        if self.preview_job is not None:
+            self.master.after_cancel(self.preview_job)
+        self.preview_job = self.master.after(15, self.update_preview)
+
+    def update_preview(self):
+        self.preview_job = None
+        if self.preview is None:
+            return
+
+        image = self.preview.render(int(self.blur_val.get()), self.brightness_val.get())
+        self.preview_image = ctk.CTkImage(light_image=image, dark_image=image, size=image.size)
+        self.preview_label.configure(image=self.preview_image, text="")
 
     def update_fade_duration_lable(self, event):
         self.fade_duration_lable.configure(text="{:.2f}".format(self.fade_duration_val.get()))
@@ -189,6 +257,45 @@ class CustomTkinterApp:
     def select_pdf(self):
         self.pdf_file = filedialog.askopenfilename(filetypes=[("PDF Files", "*.pdf")])
         self.pdf_label.configure(text=self.pdf_file.split('/')[-1])
+        self.load_preview()
+        self.start_prefetch()
+
+    def prefetch_key(self):
+        return (self.pdf_file, self.selected_tts_backend.get(), self.aws_access_key_val.get(),
+                self.aws_secret_access_key_val.get(), self.selected_aws_server.get())
+
+    def start_prefetch(self):
+        """
+        Starts extracting the pages and synthesizing the speech of the selected PDF in the background, while the
+        sliders are being set. Their results go into the caches, so Generate Video only runs the remaining stages.
+        The prefetch of a previously selected PDF or backend is cancelled.
+        """
+        self.cancel_prefetch()
+        if not self.pdf_file:
+            return
+
+        self.prefetch_settings = self.prefetch_key()
+        self.prefetch_cancel = threading.Event()
+        pdf_file, tts_backend, aws_access_key, aws_secret_access_key, aws_server = self.prefetch_settings
+        cancel = self.prefetch_cancel
+
+        def prefetch():
+            try:
+                make_video_pdf_engine.prefetch_pdf(pdf_file, aws_access_key, aws_secret_access_key, aws_server,
+                                                   tts_backend, cancel)
+            except Exception as error:
+                # Only speculative work is lost, Generate Video does it again
+                print("Prefetch failed:", error)
+
+        self.prefetch_thread = threading.Thread(target=prefetch, daemon=True)
+        self.prefetch_thread.start()
+
+    def cancel_prefetch(self):
+        if self.prefetch_cancel is not None:
+            self.prefetch_cancel.set()
+        self.prefetch_thread = None
+        self.prefetch_cancel = None
+        self.prefetch_settings = None
 
     def select_mp3(self):
         self.mp3_file = filedialog.askopenfilename(filetypes=[("MP3 Files", "*.mp3")])
@@ -206,6 +313,7 @@ class CustomTkinterApp:
         aws_access_key = self.aws_access_key_val.get()
         aws_secret_access_key = self.aws_secret_access_key_val.get()
         aws_server = self.selected_aws_server.get()
+        tts_backend = self.selected_tts_backend.get()
 
         # Call generate video function with selected values
         print("Generating video...")
@@ -219,10 +327,16 @@ class CustomTkinterApp:
         print("AWS Access key:", aws_access_key)
         print("AWS Secret Access_key:", aws_secret_access_key)
         print("AWS Server:", aws_server)
+        print("TTS Backend:", tts_backend)
+
+        # A prefetch of the same PDF and voice finishes filling the caches first, any other one is dropped
+        if self.prefetch_thread is not None and self.prefetch_settings == self.prefetch_key():
+            self.prefetch_thread.join()
+        self.cancel_prefetch()
 
         make_video_pdf_engine.make_pdf_video(pdf_file, mp3_file, blur_val, brightness_val, fade_duration_val,
                                              main_volume_val, bg_volume_val, aws_access_key, aws_secret_access_key,
-                                             aws_server)
+                                             aws_server, tts_backend=tts_backend)
 
 
 def main():
@@ -230,6 +344,7 @@ def main():
     app = CustomTkinterApp(root)
 
     def on_closing():
+        app.cancel_prefetch()
         app.save_current_values()
         root.destroy()
 